@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Core command dispatch micro-benchmark
+
+Times how long the interpreter takes to turn one line of each core
+command into a statement (parse_core), which is the work done for every
+line at compile time and for every run_line/execute_line call.
+
+Usage:
+  python benchmarks/dispatch_bench.py
+  python benchmarks/dispatch_bench.py --rounds 50000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sifzz import SifzzInterpreter
+
+# One representative line per core command
+COMMANDS = [
+    'stop script',
+    'break',
+    'end loop',
+    'else:',
+    'else if x greater than 5:',
+    'if x is 5:',
+    'loop while x less than 10:',
+    'set x to x + 1',
+    'set n to size of items',
+    'set v to item 2 of items',
+    'set r to random number between 1 and 10',
+    'set c to random choice from items',
+    'create list items',
+    'add 1 to x',
+    'remove 1 from items',
+    'clear items',
+    'say "Hello"',
+    'write "Hello"',
+    'newline',
+    'wait 1 second',
+    'subtract 1 from x',
+    'multiply x by 2',
+    'divide x by 2',
+    'call main',
+    'ask "Name?" and store in name',
+    'ask for number "Age?" and store in age',
+    'increase x',
+    'decrease x',
+    'exit',
+    'not a core command',
+]
+
+def measure(interpreter, line, rounds):
+    """Return the average parse_core time for line in microseconds"""
+    parse = interpreter.parse_core
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse(line)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Sifzz core command dispatch micro-benchmark')
+    parser.add_argument('--rounds', type=int, default=20000, help='Iterations per command')
+    args = parser.parse_args()
+
+    # Modules are not needed to parse core commands
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter = SifzzInterpreter()
+        interpreter.command_sources = []
+        interpreter.build_command_index()
+
+    total = 0.0
+    print(f"{'command':45s} {'us/line':>8s}")
+    for line in COMMANDS:
+        elapsed = measure(interpreter, line, args.rounds)
+        total += elapsed
+        print(f"{line:45s} {elapsed:8.2f}")
+    print(f"{'average':45s} {total / len(COMMANDS):8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Sifzz benchmark harness
+
+Runs every workload in benchmarks/workloads/ headlessly (a fresh
+interpreter process per run, no input, output captured) and reports the
+best wall time and the peak memory of each. Results can be saved as a
+baseline and later runs compared against it.
+
+Usage:
+  python benchmarks/run_benchmarks.py
+  python benchmarks/run_benchmarks.py --repeat 5
+  python benchmarks/run_benchmarks.py --save-baseline
+  python benchmarks/run_benchmarks.py --baseline old.json --check
+  python benchmarks/run_benchmarks.py --transpile numeric_loop if_ladder
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+WORKLOADS = BENCH_DIR / "workloads"
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+
+def run_once(workload, extra_args):
+    """Run a workload once and return (seconds, peak memory in KB or None)"""
+    command = [sys.executable, str(ROOT / "sifzz.py"), "--no-cache", *extra_args, str(workload)]
+    # stderr goes to a file so a chatty workload can't fill a pipe while
+    # we wait for it
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command,
+            cwd=ROOT,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=errors,
+        )
+        if hasattr(os, "wait4"):
+            # wait4 gives the resource usage of just this child
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_kb = usage.ru_maxrss
+            if sys.platform == "darwin":
+                peak_kb //= 1024  # bytes on macOS
+        else:
+            process.wait()
+            elapsed = time.perf_counter() - start
+            peak_kb = None
+        if process.returncode != 0:
+            errors.seek(0)
+            message = errors.read().decode(errors="replace")
+            raise RuntimeError(f"{workload.name} exited with {process.returncode}:\n{message}")
+    return elapsed, peak_kb
+
+def run_workload(workload, repeat, extra_args):
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        elapsed, peak_kb = run_once(workload, extra_args)
+        times.append(elapsed)
+        if peak_kb is not None:
+            peaks.append(peak_kb)
+    return {
+        "seconds": round(min(times), 4),
+        "mean_seconds": round(sum(times) / len(times), 4),
+        "peak_kb": max(peaks) if peaks else None,
+    }
+
+def compare(results, baseline, threshold):
+    """Print the change against the baseline; return the regressed workloads"""
+    regressions = []
+    print(f"\nCompared with baseline ({baseline.get('python', '?')}, {baseline.get('platform', '?')}):")
+    print(f"{'workload':20s} {'time':>9s} {'memory':>9s}")
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            print(f"{name:20s} {'(new)':>9s}")
+            continue
+        time_change = (result["seconds"] / old["seconds"] - 1) * 100
+        if result["peak_kb"] and old.get("peak_kb"):
+            memory = f"{(result['peak_kb'] / old['peak_kb'] - 1) * 100:+8.1f}%"
+        else:
+            memory = f"{'-':>9s}"
+        flag = "  REGRESSION" if time_change > threshold else ""
+        print(f"{name:20s} {time_change:+8.1f}% {memory}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Sifzz benchmark workloads')
+    parser.add_argument('workloads', nargs='*', help='Workload names to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per workload; the best time is reported')
+    parser.add_argument('--transpile', action='store_true', help='Run the workloads with --transpile')
+    parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='Baseline JSON to compare against or save to')
+    parser.add_argument('--save-baseline', action='store_true', help='Save these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent slowdown that counts as a regression')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if any workload regressed')
+    args = parser.parse_args()
+
+    workloads = sorted(WORKLOADS.glob("*.sfzz"))
+    if args.workloads:
+        workloads = [workload for workload in workloads if workload.stem in args.workloads]
+    extra_args = ["--transpile"] if args.transpile else []
+
+    results = {}
+    print(f"{'workload':20s} {'best s':>9s} {'mean s':>9s} {'peak MB':>9s}")
+    for workload in workloads:
+        result = run_workload(workload, args.repeat, extra_args)
+        results[workload.stem] = result
+        peak = f"{result['peak_kb'] / 1024:9.1f}" if result["peak_kb"] else f"{'-':>9s}"
+        print(f"{workload.stem:20s} {result['seconds']:9.3f} {result['mean_seconds']:9.3f} {peak}")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        data = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "transpile": args.transpile,
+            "results": results,
+        }
+        baseline_path.write_text(json.dumps(data, indent=2) + "\n")
+        print(f"\nSaved baseline to {baseline_path}")
+        return
+
+    if baseline_path.exists():
+        regressions = compare(results, json.loads(baseline_path.read_text()), args.threshold)
+        if regressions and args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
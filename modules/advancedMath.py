@@ -5,28 +5,32 @@ Advanced Math Operations Module
 
 """
 
-from sifzz import SifzzModule
+from sifzz import SifzzModule, load_numpy
+from array import array
 import math
+import statistics
+
+# Functions that can be used with `set x to NAME(...)` or `NAME of each`
+FUNCTIONS = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'sqrt': math.sqrt,
+    'log': math.log,
+    'exp': math.exp,
+    'abs': abs,
+}
 
 class MathModule(SifzzModule):
-    def register_commands(self):
-        self.register(
-            r'set (\w+) to sin\((.+)\)',
-            self.calc_sin,
-            "Calculate sine"
-        )
-        
-        self.register(
-            r'set (\w+) to cos\((.+)\)',
-            self.calc_cos,
-            "Calculate cosine"
-        )
-        
-        self.register(
-            r'set (\w+) to power\((.+), (.+)\)',
-            self.calc_power,
-            "Calculate power (base, exponent)"
-        )
+    COMMANDS = [
+        (r'set (\w+) to sin\((.+)\)', 'calc_sin', "Calculate sine"),
+        (r'set (\w+) to cos\((.+)\)', 'calc_cos', "Calculate cosine"),
+        (r'set (\w+) to power\((.+), (.+)\)', 'calc_power', "Calculate power (base, exponent)"),
+        (r'set (\w+) to (tan|log|exp)\((.+)\)', 'calc_function', "Calculate tangent, natural logarithm or e to the power"),
+        (r'set (\w+) to (sin|cos|tan|sqrt|log|exp|abs) of each (\w+)$', 'calc_each', "Apply a function to every number of a list or array"),
+        (r'set (\w+) to power of each (\w+) to (.+)$', 'calc_power_each', "Raise every number of a list or array to a power"),
+        (r'set (\w+) to (mean|stddev) of (\w+)$', 'calc_statistic', "Calculate the mean or standard deviation of a list or array"),
+    ]
     
     def calc_sin(self, match):
         var_name = match.group(1)
@@ -42,4 +46,75 @@ class MathModule(SifzzModule):
         var_name = match.group(1)
         base = self.interpreter.eval_expression(match.group(2))
         exp = self.interpreter.eval_expression(match.group(3))
-        self.interpreter.variables[var_name] = math.pow(float(base), float(exp))
\ No newline at end of file
+        self.interpreter.variables[var_name] = math.pow(float(base), float(exp))
+    
+    def calc_function(self, match):
+        var_name, name = match.group(1), match.group(2)
+        value = self.interpreter.eval_expression(match.group(3))
+        self.interpreter.variables[var_name] = FUNCTIONS[name](float(value))
+    
+    def calc_each(self, match):
+        target, name, source = match.groups()
+        numbers = self.numbers(source)
+        numpy = load_numpy()
+        if numpy is not None and numbers:
+            with numpy.errstate(invalid='raise', divide='raise', over='raise'):
+                result = getattr(numpy, name)(self.as_numpy(numpy, numbers))
+            self.store(target, numbers, result)
+        else:
+            self.store(target, numbers, map(FUNCTIONS[name], numbers))
+    
+    def calc_power_each(self, match):
+        target, source = match.group(1), match.group(2)
+        exponent = float(self.interpreter.eval_expression(match.group(3)))
+        numbers = self.numbers(source)
+        numpy = load_numpy()
+        if numpy is not None and numbers:
+            with numpy.errstate(invalid='raise', divide='raise', over='raise'):
+                result = numpy.power(self.as_numpy(numpy, numbers), exponent)
+            self.store(target, numbers, result)
+        else:
+            self.store(target, numbers, (math.pow(value, exponent) for value in numbers))
+    
+    def calc_statistic(self, match):
+        var_name, name, source = match.groups()
+        numbers = self.numbers(source)
+        if not numbers:
+            raise ValueError(f"{source} is empty")
+        numpy = load_numpy()
+        if numpy is not None:
+            values = self.as_numpy(numpy, numbers)
+            result = values.mean() if name == 'mean' else values.std()
+        elif name == 'mean':
+            result = statistics.fmean(numbers)
+        else:
+            result = statistics.pstdev(map(float, numbers))
+        self.interpreter.variables[var_name] = float(result)
+    
+    def numbers(self, name):
+        """The list or number array called name"""
+        numbers = self.interpreter.lists.get(name)
+        if type(numbers) is not list and type(numbers) is not array:
+            raise ValueError(f"{name} is not a list or number array")
+        return numbers
+    
+    def as_numpy(self, numpy, numbers):
+        if type(numbers) is array:
+            # Uses the array's own memory, nothing is copied
+            return numpy.frombuffer(numbers)
+        return numpy.array(numbers, dtype=numpy.float64)
+    
+    def store(self, target, source, result):
+        """Store the results as a list, or as a number array if the numbers
+        came from one"""
+        if type(source) is array:
+            numbers = array('d')
+            if hasattr(result, 'tobytes'):
+                numbers.frombytes(result.tobytes())
+            else:
+                numbers.extend(result)
+        elif hasattr(result, 'tolist'):
+            numbers = result.tolist()
+        else:
+            numbers = list(result)
+        self.interpreter.lists[target] = numbers
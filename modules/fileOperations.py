@@ -32,57 +32,28 @@ import re
 class FileOperationsModule(SifzzModule):
     """Adds file I/O operations to Sifzz"""
     
-    def register_commands(self):
-        """Register all file operation commands"""
-        
+    COMMANDS = [
         # Read file
-        self.register(
-            r'read file "([^"]+)" and store in (\w+)',
-            self.read_file,
-            "Read contents of a file into a variable"
-        )
-        
+        (r'read file "([^"]+)" and store in (\w+)', 'read_file', "Read contents of a file into a variable"),
+
         # Write file
-        self.register(
-            r'write "([^"]+)" to file "([^"]+)"',
-            self.write_file,
-            "Write text to a file (overwrites)"
-        )
-        
+        (r'write "([^"]+)" to file "([^"]+)"', 'write_file', "Write text to a file (overwrites)"),
+
         # Write variable to file
-        self.register(
-            r'write (\w+) to file "([^"]+)"',
-            self.write_var_to_file,
-            "Write variable contents to a file"
-        )
-        
+        (r'write (\w+) to file "([^"]+)"', 'write_var_to_file', "Write variable contents to a file"),
+
         # Append to file
-        self.register(
-            r'append "([^"]+)" to file "([^"]+)"',
-            self.append_file,
-            "Append text to a file"
-        )
-        
+        (r'append "([^"]+)" to file "([^"]+)"', 'append_file', "Append text to a file"),
+
         # Append variable to file
-        self.register(
-            r'append (\w+) to file "([^"]+)"',
-            self.append_var_to_file,
-            "Append variable contents to a file"
-        )
-        
+        (r'append (\w+) to file "([^"]+)"', 'append_var_to_file', "Append variable contents to a file"),
+
         # Delete file
-        self.register(
-            r'delete file "([^"]+)"',
-            self.delete_file,
-            "Delete a file"
-        )
-        
+        (r'delete file "([^"]+)"', 'delete_file', "Delete a file"),
+
         # Check if file exists
-        self.register(
-            r'set (\w+) to file "([^"]+)" exists',
-            self.file_exists,
-            "Check if a file exists"
-        )
+        (r'set (\w+) to file "([^"]+)" exists', 'file_exists', "Check if a file exists"),
+    ]
     
     def read_file(self, match):
         """Read file contents into a variable"""
@@ -64,43 +64,14 @@ class SoundModule(SifzzModule):
             except Exception as e:
                 print(f"[WARNING] Failed to cleanup temp file {temp_file}: {e}")
     
-    def register_commands(self):
-        """Register sound commands"""
-        self.register(
-            r'play beep frequency (\d+) duration (\d+)',
-            self.play_beep,
-            "Play a beep with specified frequency and duration (ms)"
-        )
-        
-        self.register(
-            r'play sound "([^"]+)"',
-            self.play_sound_file,
-            "Play an audio file (supports various formats)"
-        )
-        
-        self.register(
-            r'play url "([^"]+)"',
-            self.play_url,
-            "Play audio from URL"
-        )
-        
-        self.register(
-            r'stop sound',
-            self.stop_sound,
-            "Stop currently playing sound"
-        )
-        
-        self.register(
-            r'set volume (\d+)',
-            self.set_volume,
-            "Set playback volume (0-100)"
-        )
-        
-        self.register(
-            r'get duration "([^"]+)"',
-            self.get_duration,
-            "Get audio file duration in seconds"
-        )
+    COMMANDS = [
+        (r'play beep frequency (\d+) duration (\d+)', 'play_beep', "Play a beep with specified frequency and duration (ms)"),
+        (r'play sound "([^"]+)"', 'play_sound_file', "Play an audio file (supports various formats)"),
+        (r'play url "([^"]+)"', 'play_url', "Play audio from URL"),
+        (r'stop sound', 'stop_sound', "Stop currently playing sound"),
+        (r'set volume (\d+)', 'set_volume', "Set playback volume (0-100)"),
+        (r'get duration "([^"]+)"', 'get_duration', "Get audio file duration in seconds"),
+    ]
     
     def play_beep(self, match):
         """Play a beep sound cross-platform"""
@@ -57,99 +57,38 @@ class TkinterModule(SifzzModule):
         if not TKINTER_AVAILABLE:
             print("[ERROR] Tkinter module failed to load - tkinter not installed")
 
-    def register_commands(self):
-        if not TKINTER_AVAILABLE:
-            return
-            
+    COMMANDS = [
         # Window management
-        self.register(
-            r'create window "([^"]+)" width (\d+) height (\d+)',
-            self.create_window,
-            "Create a GUI window with title, width, and height"
-        )
-        self.register(
-            r'close window',
-            self.close_window,
-            "Close the GUI window"
-        )
-        self.register(
-            r'start gui',
-            self.start_gui,
-            "Start the GUI event loop"
-        )
-        
+        (r'create window "([^"]+)" width (\d+) height (\d+)', 'create_window', "Create a GUI window with title, width, and height"),
+        (r'close window', 'close_window', "Close the GUI window"),
+        (r'start gui', 'start_gui', "Start the GUI event loop"),
+
         # Basic widgets
-        self.register(
-            r'add label "([^"]+)" at x (\d+) y (\d+)',
-            self.add_label,
-            "Add a label at x,y coordinates"
-        )
-        self.register(
-            r'add button "([^"]+)" at x (\d+) y (\d+) and run "([^"]+)" on click',
-            self.add_button,
-            "Add a button at x,y that executes a Sifzz command on click"
-        )
-        self.register(
-            r'add entry at x (\d+) y (\d+) store in (\w+)',
-            self.add_entry,
-            "Add a text entry field and store its value in a variable"
-        )
-        
+        (r'add label "([^"]+)" at x (\d+) y (\d+)', 'add_label', "Add a label at x,y coordinates"),
+        (r'add button "([^"]+)" at x (\d+) y (\d+) and run "([^"]+)" on click', 'add_button', "Add a button at x,y that executes a Sifzz command on click"),
+        (r'add entry at x (\d+) y (\d+) store in (\w+)', 'add_entry', "Add a text entry field and store its value in a variable"),
+
         # Advanced widgets
-        self.register(
-            r'add text box at x (\d+) y (\d+) width (\d+) height (\d+) store in (\w+)',
-            self.add_text_box,
-            "Add a multi-line text box"
-        )
-        self.register(
-            r'add checkbox "([^"]+)" at x (\d+) y (\d+) store in (\w+)',
-            self.add_checkbox,
-            "Add a checkbox"
-        )
-        self.register(
-            r'add dropdown at x (\d+) y (\d+) options (\w+) store in (\w+)',
-            self.add_dropdown,
-            "Add a dropdown menu from a list"
-        )
-        
+        (r'add text box at x (\d+) y (\d+) width (\d+) height (\d+) store in (\w+)', 'add_text_box', "Add a multi-line text box"),
+        (r'add checkbox "([^"]+)" at x (\d+) y (\d+) store in (\w+)', 'add_checkbox', "Add a checkbox"),
+        (r'add dropdown at x (\d+) y (\d+) options (\w+) store in (\w+)', 'add_dropdown', "Add a dropdown menu from a list"),
+
         # Widget manipulation
-        self.register(
-            r'update label "([^"]+)" to "([^"]+)"',
-            self.update_label,
-            "Update label text"
-        )
-        self.register(
-            r'get entry (\w+)',
-            self.get_entry,
-            "Get the current value from an entry field"
-        )
-        self.register(
-            r'clear entry (\w+)',
-            self.clear_entry,
-            "Clear an entry field"
-        )
-        
+        (r'update label "([^"]+)" to "([^"]+)"', 'update_label', "Update label text"),
+        (r'get entry (\w+)', 'get_entry', "Get the current value from an entry field"),
+        (r'clear entry (\w+)', 'clear_entry', "Clear an entry field"),
+
         # Dialogs
-        self.register(
-            r'show message "([^"]+)" "([^"]+)"',
-            self.show_message,
-            "Show an info message dialog"
-        )
-        self.register(
-            r'show error "([^"]+)" "([^"]+)"',
-            self.show_error,
-            "Show an error message dialog"
-        )
-        self.register(
-            r'show warning "([^"]+)" "([^"]+)"',
-            self.show_warning,
-            "Show a warning message dialog"
-        )
-        self.register(
-            r'ask yes/no "([^"]+)" "([^"]+)" store in (\w+)',
-            self.ask_yesno,
-            "Show a yes/no dialog and store result"
-        )
+        (r'show message "([^"]+)" "([^"]+)"', 'show_message', "Show an info message dialog"),
+        (r'show error "([^"]+)" "([^"]+)"', 'show_error', "Show an error message dialog"),
+        (r'show warning "([^"]+)" "([^"]+)"', 'show_warning', "Show a warning message dialog"),
+        (r'ask yes/no "([^"]+)" "([^"]+)" store in (\w+)', 'ask_yesno', "Show a yes/no dialog and store result"),
+    ]
+    
+    def register_commands(self):
+        if not TKINTER_AVAILABLE:
+            return
+        super().register_commands()
 
     def create_window(self, match):
         title = match.group(1)
@@ -30,36 +30,19 @@ import re
 class WebModule(SifzzModule):
     """Adds HTTP/Web operations to Sifzz"""
     
-    def register_commands(self):
-        """Register all web operation commands"""
-        
+    COMMANDS = [
         # HTTP GET
-        self.register(
-            r'get "([^"]+)" and store in (\w+)',
-            self.http_get,
-            "Make HTTP GET request and store response"
-        )
-        
+        (r'get "([^"]+)" and store in (\w+)', 'http_get', "Make HTTP GET request and store response"),
+
         # HTTP POST
-        self.register(
-            r'post "([^"]+)" to "([^"]+)" and store in (\w+)',
-            self.http_post,
-            "Make HTTP POST request with data"
-        )
-        
+        (r'post "([^"]+)" to "([^"]+)" and store in (\w+)', 'http_post', "Make HTTP POST request with data"),
+
         # Download file
-        self.register(
-            r'download "([^"]+)" as "([^"]+)"',
-            self.download_file,
-            "Download a file from URL"
-        )
-        
+        (r'download "([^"]+)" as "([^"]+)"', 'download_file', "Download a file from URL"),
+
         # Set HTTP timeout
-        self.register(
-            r'set http timeout to (\d+)',
-            self.set_timeout,
-            "Set HTTP request timeout in seconds"
-        )
+        (r'set http timeout to (\d+)', 'set_timeout', "Set HTTP request timeout in seconds"),
+    ]
     
     def __init__(self, interpreter):
         super().__init__(interpreter)
@@ -13,16 +13,29 @@ Sifzz (.sfzz) Interpreter
 ###############
 
 import re
+import os
 import sys
 import random
 import time
 import math
+import hashlib
+import tempfile
+import json
+import marshal
+import operator
+import itertools
 import importlib.util
+import ast
 from pathlib import Path
 import subprocess
 import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import tkinter as tk
 
+SIFZZ_VERSION = '3.2'
+
 ########################
 ### Debug Mode Logic ###
 ########################
@@ -75,24 +88,2306 @@ class PackageAPI:
 ### Addon Modules ###
 #####################
 
+# Characters that end the literal start of a regex pattern
+REGEX_SPECIAL = set('.^$*+?{}[]|()\\')
+
+def leading_word(pattern):
+    """Return the literal first word of a pattern, or None if it has none.
+
+    A word only counts if the pattern spells it out in full and follows it
+    with a literal space, so any line the pattern can match starts with
+    exactly that word.
+    """
+    if '|' in pattern:
+        return None
+    for i, char in enumerate(pattern):
+        if char == ' ':
+            word = pattern[:i]
+            # A quantifier after the space could make it optional
+            if word and pattern[i + 1:i + 2] not in ('*', '?', '{'):
+                return word
+            return None
+        if char in REGEX_SPECIAL:
+            return None
+    return None
+
+class CommandIndex:
+    """Dispatch index over compiled command patterns.
+
+    Patterns are bucketed by their literal first word. Each bucket holds the
+    patterns for that word plus the ones without a literal first word, in
+    registration order, combined into a single alternation regex, so a line
+    costs one dictionary lookup and (at most) one regex search to find the
+    first registered pattern that matches it.
+    """
+    
+    def __init__(self):
+        self.entries = []
+        self.by_pattern = {}
+        self.buckets = None
+        self.fallback = (None, [])
+    
+    def add(self, pattern, regex, handler):
+        """Add a pattern - earlier patterns win over later ones"""
+        self.entries.append((pattern, regex, handler))
+        self.by_pattern.setdefault(pattern, (regex, handler))
+        self.buckets = None
+    
+    def patterns(self):
+        """All patterns in priority order"""
+        return [entry[0] for entry in self.entries]
+    
+    def lookup(self, pattern):
+        """Return (regex, handler) registered for an exact pattern, or None"""
+        return self.by_pattern.get(pattern)
+    
+    def build(self):
+        keyed = {}
+        wildcards = []
+        for entry in self.entries:
+            word = leading_word(entry[0])
+            if word is None:
+                wildcards.append(entry)
+                for bucket in keyed.values():
+                    bucket.append(entry)
+            else:
+                keyed.setdefault(word, list(wildcards)).append(entry)
+        
+        self.buckets = {word: self.make_bucket(entries) for word, entries in keyed.items()}
+        self.fallback = self.make_bucket(wildcards)
+    
+    def make_bucket(self, entries):
+        """Combine a bucket's patterns into one alternation when it is safe"""
+        if len(entries) < 2:
+            return (None, entries)
+        for pattern, regex, handler in entries:
+            # Named groups and backreferences change meaning when combined
+            if regex.groupindex or re.search(r'\\\d|\(\?P?[=<]', pattern):
+                return (None, entries)
+        try:
+            combined = re.compile('|'.join(
+                f'(?P<_{n}>{entry[0]})' for n, entry in enumerate(entries)
+            ))
+        except re.error:
+            return (None, entries)
+        return (combined, entries)
+    
+    def match(self, line):
+        """Return (handler, match) for the first pattern matching line"""
+        if self.buckets is None:
+            self.build()
+        
+        combined, entries = self.buckets.get(line.split(' ', 1)[0], self.fallback)
+        if not entries:
+            return None
+        
+        if combined is not None:
+            found = combined.match(line)
+            if found is None:
+                return None
+            pattern, regex, handler = entries[int(found.lastgroup[1:])]
+            return handler, regex.match(line)
+        
+        for pattern, regex, handler in entries:
+            found = regex.match(line)
+            if found:
+                return handler, found
+        return None
+
 class SifzzModule:
-    """Base class for Sifzz modules"""
+    """Base class for Sifzz modules.
+    
+    Modules can list their commands in COMMANDS as literal
+    (pattern, handler method name, description) tuples. The interpreter
+    reads that list from the source without importing the module, and only
+    imports and creates the module the first time one of its commands runs.
+    """
+    
+    COMMANDS = ()
     
     def __init__(self, interpreter):
         self.interpreter = interpreter
         self.commands = {}
         self.register_commands()
     
+    def add_hook(self, event, callback):
+        """Call callback on an interpreter event, see HookManager"""
+        self.interpreter.hooks.add(event, callback)
+    
     def register_commands(self):
         """Override this method to register module commands"""
-        pass
+        for pattern, handler_name, description in self.COMMANDS:
+            self.register(pattern, getattr(self, handler_name), description)
     
     def register(self, pattern, handler, description=""):
         """Register a command pattern with its handler"""
+        regex = re.compile(pattern)
         self.commands[pattern] = {
             'handler': handler,
-            'description': description
+            'description': description,
+            'regex': regex
+        }
+
+def read_manifest(module_file):
+    """Read the COMMANDS manifests of the SifzzModule classes in a file.
+    
+    The file is parsed, not imported. Returns a list of
+    (class name, [(pattern, handler name, description), ...]) in file
+    order, or None if
+    the file cannot be loaded lazily (it does not parse, a module class
+    has no literal COMMANDS, or it has no module classes at all).
+    """
+    try:
+        tree = ast.parse(Path(module_file).read_text(encoding='utf-8'))
+    except (OSError, SyntaxError, ValueError):
+        return None
+    
+    manifests = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        base_names = {
+            base.id if isinstance(base, ast.Name) else getattr(base, 'attr', None)
+            for base in node.bases
         }
+        if 'SifzzModule' not in base_names:
+            continue
+        
+        commands = None
+        for item in node.body:
+            if (isinstance(item, ast.Assign) and len(item.targets) == 1
+                    and isinstance(item.targets[0], ast.Name)
+                    and item.targets[0].id == 'COMMANDS'):
+                try:
+                    commands = [
+                        (pattern, handler_name, description)
+                        for pattern, handler_name, description in ast.literal_eval(item.value)
+                    ]
+                except (ValueError, TypeError, SyntaxError):
+                    return None
+        if commands is None:
+            return None
+        manifests.append((node.name, commands))
+    
+    return manifests or None
+
+class LazyModule:
+    """A module class known only from its manifest until it is needed.
+    
+    `commands` has the same shape as SifzzModule.commands, but every handler
+    imports the module file and creates the module the first time it is
+    called, then forwards to the real handler.
+    """
+    
+    def __init__(self, interpreter, module_file, class_name, manifest):
+        self.interpreter = interpreter
+        self.module_file = module_file
+        self.class_name = class_name
+        self.instance = None
+        self.failed = False
+        self.handlers = {}
+        self.commands = {}
+        for pattern, handler_name, description in manifest:
+            self.commands[pattern] = {
+                'handler': self.make_handler(pattern, handler_name),
+                'description': description,
+                'regex': re.compile(pattern)
+            }
+    
+    def make_handler(self, pattern, handler_name):
+        def handler(match):
+            try:
+                real_handler = self.handlers[pattern]
+            except KeyError:
+                real_handler = self.handlers[pattern] = self.resolve(pattern)
+            return real_handler(match)
+        handler.__name__ = handler_name
+        handler.__qualname__ = f"{self.class_name}.{handler_name}"
+        return handler
+    
+    def load(self):
+        """Import and create the module if that has not happened yet.
+        Returns None if that failed (it is only tried once)."""
+        if self.instance is None and not self.failed:
+            try:
+                module = self.interpreter.import_module_file(self.module_file)
+                self.instance = getattr(module, self.class_name)(self.interpreter)
+            except Exception as e:
+                self.failed = True
+                self.interpreter.output.write(f"[WARNING] Failed to load module {self.module_file.stem}: {e}\n")
+                if DEBUG_MODE:
+                    import traceback
+                    traceback.print_exc()
+                return None
+            self.interpreter.modules.append(self.instance)
+            # Loading happens in the middle of the script, so this is only
+            # shown when debugging instead of between the script's output
+            if DEBUG_MODE:
+                print(f"[DEBUG] Loaded module: {self.module_file.stem}")
+        return self.instance
+    
+    def resolve(self, pattern):
+        instance = self.load()
+        if instance is not None and pattern in instance.commands:
+            return instance.commands[pattern]['handler']
+        
+        # The module did not load, or left this command out when it loaded
+        # (like a GUI module without tkinter), so lines using it are unknown
+        # commands
+        output = self.interpreter.output
+        if instance is not None:
+            output.write(f"[WARNING] Module {self.module_file.stem} did not register '{pattern}'\n")
+        return lambda match: output.write(f"[WARNING] Unknown command: {match.string}\n")
+
+################
+### Compiler ###
+################
+
+# Every block opener and the line that closes it
+BLOCK_ENDERS = {
+    'if': 'end if',
+    'loop': 'end loop',
+    'repeat': 'end repeat',
+    'foreach': 'end for',
+    'function': 'end function'
+}
+
+class Statement:
+    """A single compiled line of Sifzz code.
+
+    `kind` selects the executor, `args` holds the operands that were
+    extracted from the source text at compile time, with expressions already
+    parsed into trees. `code` is `args` with every tree linked into a
+    closure. Block openers also get `end` (index of their closing line) and,
+    for if statements, `branches` from match_blocks().
+    """
+
+    __slots__ = ('kind', 'args', 'lineno', 'text', 'code', 'end', 'branches')
+
+    def __init__(self, kind, args=(), lineno=0, text=''):
+        self.kind = kind
+        self.args = args
+        self.lineno = lineno
+        self.text = text
+        self.code = args
+        self.end = None
+        self.branches = ()
+
+    def __repr__(self):
+        return f"Statement({self.kind!r}, {self.args!r}, line {self.lineno})"
+
+def match_blocks(nodes):
+    """Link every block opener to its else if/else lines and its end line.
+
+    This is a single pass with a stack of open blocks, so control flow can
+    jump with O(1) lookups at runtime. Each if statement gets `branches`, a
+    tuple of (header index, body end index) pairs for the if line and each
+    of its own else if/else lines. Blocks that are never closed end at the
+    end of the script.
+    """
+    stack = []
+    headers = {}
+    
+    for i, stmt in enumerate(nodes):
+        if stmt is None:
+            continue
+        
+        kind = stmt.kind
+        if kind in BLOCK_ENDERS:
+            stack.append(i)
+            headers[i] = [i]
+        elif kind in ('elseif', 'else'):
+            # Only belongs to the innermost open block if that is an if
+            if stack and nodes[stack[-1]].kind == 'if':
+                headers[stack[-1]].append(i)
+        elif kind == 'end' and stack:
+            close_block(nodes, stack.pop(), i, headers)
+    
+    while stack:
+        close_block(nodes, stack.pop(), len(nodes), headers)
+    
+    return nodes
+
+def close_block(nodes, start, end, headers):
+    """Record the end (and branch bounds) of the block opened at start"""
+    opener = nodes[start]
+    opener.end = end
+    if opener.kind == 'if':
+        branch_headers = headers[start]
+        bounds = branch_headers[1:] + [end]
+        opener.branches = tuple(zip(branch_headers, bounds))
+
+def remove_dead_branches(nodes):
+    """Drop if/else if/else branches and while loops that can never run.
+    
+    Expressions must already be folded, so a branch whose condition is
+    always false is skipped for good and a branch whose condition is always
+    true makes every later branch unreachable. Removed lines become None,
+    like blank lines, and the first branch that is left takes over as the
+    if statement. Branches that define functions are kept, since functions
+    are available wherever they are written. Returns the number of
+    statements removed.
+    """
+    removed = 0
+    
+    def clear(start, end):
+        nonlocal removed
+        for i in range(start, end):
+            if nodes[i] is not None:
+                nodes[i] = None
+                removed += 1
+    
+    def defines_function(start, end):
+        return any(stmt is not None and stmt.kind == 'function' for stmt in nodes[start:end])
+    
+    for i, stmt in enumerate(nodes):
+        if stmt is None or stmt.args[:1] == (None,):
+            continue
+        
+        if stmt.kind == 'loop':
+            condition = stmt.args[0]
+            if condition[0] == 'const' and not condition[1] and not defines_function(i, stmt.end):
+                clear(i, min(stmt.end + 1, len(nodes)))
+            continue
+        
+        if stmt.kind != 'if':
+            continue
+        
+        end = stmt.end
+        kept = []
+        for header, body_end in stmt.branches:
+            branch = nodes[header]
+            condition = branch.args[0] if branch.kind != 'else' else ('const', True)
+            if condition is None or condition[0] != 'const' or defines_function(header, body_end):
+                kept.append((header, body_end, False))
+            elif condition[1]:
+                # Always taken, so nothing after it can run
+                kept.append((header, body_end, True))
+                break
+        
+        if len(kept) == len(stmt.branches):
+            continue
+        
+        kept_headers = {header for header, _, _ in kept}
+        for header, body_end in stmt.branches:
+            if header not in kept_headers:
+                clear(header, body_end)
+        
+        if not kept:
+            clear(i, min(end + 1, len(nodes)))
+        elif kept[0][2]:
+            # The first branch left always runs: keep just its body
+            clear(kept[0][0], kept[0][0] + 1)
+            clear(end, min(end + 1, len(nodes)))
+        else:
+            first = nodes[kept[0][0]]
+            first.kind = 'if'
+            first.end = end
+            first.branches = tuple((header, body_end) for header, body_end, _ in kept)
+            last = nodes[kept[-1][0]]
+            if kept[-1][2] and last is not first:
+                last.kind = 'else'
+                last.args = ()
+    
+    return removed
+
+# Core command patterns, compiled once
+RE_IF = re.compile(r'if (.+):')
+RE_ELSE_IF = re.compile(r'else if (.+):')
+RE_LOOP_WHILE = re.compile(r'loop while (.+):')
+RE_REPEAT = re.compile(r'repeat (.+) times?:$')
+RE_FOR_EACH = re.compile(r'for each (\w+) in (.+):$')
+RE_RANGE = re.compile(r'range\((.*)\)$')
+RE_SET = re.compile(r'set (\w+) to (.+)')
+RE_SET_SIZE = re.compile(r'set (\w+) to size of (\w+)$')
+RE_SET_ITEM = re.compile(r'set (\w+) to item (.+) of (\w+)$')
+RE_SET_RANDOM_NUMBER = re.compile(r'set (\w+) to random number between (.+) and (.+)')
+RE_SET_RANDOM_CHOICE = re.compile(r'set (\w+) to random choice from (\w+)$')
+RE_SET_RANDOM_SEED = re.compile(r'set random seed to (.+)')
+RE_SET_SAMPLE = re.compile(r'set (\w+) to sample (.+) from (\w+)$')
+RE_FILL_RANDOM = re.compile(r'fill list (\w+) with (.+) random numbers? between (.+) and (.+)$')
+RE_SHUFFLE = re.compile(r'shuffle (\w+)$')
+RE_SET_KEY = re.compile(r'set key (.+) of (\w+) to (.+)')
+RE_SET_AGGREGATE = re.compile(r'set (\w+) to (sum|max|min) of (\w+)$')
+RE_SET_ITEMS = re.compile(r'set (\w+) to items (.+) to (.+) of (\w+)$')
+RE_SORT = re.compile(r'sort (\w+)$')
+RE_REVERSE = re.compile(r'reverse (\w+)$')
+RE_REMOVE_DUPLICATES = re.compile(r'remove duplicates from (\w+)$')
+RE_CREATE_ARRAY = re.compile(r'create number array (\w+)(?: from (\w+))?$')
+RE_ARRAY_ADD = re.compile(r'add (.+) to array (\w+)$')
+RE_ARRAY_SUBTRACT = re.compile(r'subtract (.+) from array (\w+)$')
+RE_ARRAY_MULTIPLY = re.compile(r'multiply array (\w+) by (.+)$')
+RE_ARRAY_DIVIDE = re.compile(r'divide array (\w+) by (.+)$')
+RE_ARRAY_OPERAND = re.compile(r'array (\w+)$')
+RE_SET_ARRAY_COMPARE = re.compile(
+    r'set (\w+) to array (\w+) (is not|is|equals|greater than or equal to|'
+    r'less than or equal to|greater than|less than) (.+)$'
+)
+RE_ADD = re.compile(r'add (.+) to (\w+)')
+RE_REMOVE = re.compile(r'remove (.+) from (\w+)')
+RE_WAIT = re.compile(r'wait (\d+\.?\d*) seconds?')
+RE_SUBTRACT = re.compile(r'subtract (.+) from (\w+)')
+RE_MULTIPLY = re.compile(r'multiply (\w+) by (.+)')
+RE_DIVIDE = re.compile(r'divide (\w+) by (.+)')
+RE_ASK = re.compile(r'ask "([^"]+)" and store in (\w+)')
+RE_ASK_NUMBER = re.compile(r'ask for number "([^"]+)" and store in (\w+)')
+RE_FUNCTION = re.compile(r'function (\w+)\s*(?:\((.*)\))?\s*:$')
+RE_CALL = re.compile(r'call (\w+)\s*(?:\((.*)\))?$')
+
+# Commands that make up a whole line, and the statement kind they compile to
+EXACT_COMMANDS = {
+    'stop script': 'stop',
+    'break': 'break',
+    'continue': 'continue',
+    'newline': 'newline',
+    'exit': 'exit',
+    'flush output': 'flush',
+}
+EXACT_COMMANDS.update((marker, 'end') for marker in BLOCK_ENDERS.values())
+
+# Positions of statement args that name a variable; link() turns them into
+# slot numbers
+VARIABLE_ARGS = {
+    'set': (0,),
+    'size': (0,),
+    'item': (0,),
+    'random_number': (0,),
+    'random_choice': (0,),
+    'aggregate': (0,),
+    'add': (1,),
+    'subtract': (1,),
+    'multiply': (0,),
+    'divide': (0,),
+    'ask': (1,),
+    'ask_number': (1,),
+    'increase': (0,),
+    'decrease': (0,),
+    'foreach': (0,),
+}
+
+# Statement kinds that always assign their variable; the others in
+# VARIABLE_ARGS only count as a write if the variable's value changed
+ALWAYS_WRITTEN = {'set', 'random_number', 'ask', 'ask_number', 'increase', 'decrease'}
+
+def has_raw_expression(stmt):
+    """True if any expression in the statement failed to parse"""
+    return any(type(arg) is tuple and arg[0] == 'raw' for arg in stmt.args)
+
+def split_arguments(text):
+    """Split a comma separated argument list, ignoring commas in strings
+    and parentheses"""
+    parts = []
+    depth = 0
+    in_string = False
+    current = ''
+    for char in text:
+        if char == '"':
+            in_string = not in_string
+        elif not in_string:
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == ',' and depth == 0:
+                parts.append(current.strip())
+                current = ''
+                continue
+        current += char
+    if current.strip() or parts:
+        parts.append(current.strip())
+    return parts
+
+def fold_statement(stmt):
+    """Fold the constant parts of a statement's expressions.
+    
+    `say` with a constant becomes `say_text` with the text to print. Returns
+    the number of expression nodes that were folded away.
+    """
+    folded = 0
+    args = []
+    for arg in stmt.args:
+        if type(arg) is tuple:
+            new_arg = fold_constants(arg)
+            folded += count_nodes(arg) - count_nodes(new_arg)
+            arg = new_arg
+        args.append(arg)
+    stmt.args = tuple(args)
+    
+    if stmt.kind == 'say' and stmt.args[0][0] in ('const', 'raw'):
+        stmt.kind = 'say_text'
+        stmt.args = (to_text(stmt.args[0][1]),)
+    return folded
+
+def strip_comment(line):
+    """Strip whitespace and any trailing # comment that is outside a string"""
+    if '#' in line:
+        in_string = False
+        for i, char in enumerate(line):
+            if char == '"':
+                in_string = not in_string
+            elif char == '#' and not in_string:
+                line = line[:i]
+                break
+    return line.strip()
+
+###################
+### Expressions ###
+###################
+
+class ExpressionError(Exception):
+    """Raised when an expression cannot be parsed"""
+    pass
+
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<num>\d+\.\d*|\.\d+|\d+)
+      | "(?P<str>[^"]*)"
+      | (?P<name>[A-Za-z_]\w*)
+      | (?P<op>==|!=|<=|>=|\*\*|//|[-+*/%()<>,])
+    )
+''', re.VERBOSE)
+
+# Functions that can be called with parentheses inside expressions
+BUILTIN_FUNCTIONS = {
+    'sqrt': math.sqrt,
+    'round': round,
+    'abs': abs,
+}
+
+# Binding power of each infix operator (higher binds tighter)
+BINARY_POWER = {
+    'or': 10,
+    'and': 20,
+    '==': 40, '!=': 40, '<': 40, '>': 40, '<=': 40, '>=': 40,
+    'contains': 40,
+    '+': 50, '-': 50,
+    '*': 60, '/': 60, '//': 60, '%': 60,
+    # Above unary minus, so -2 ** 2 is -(2 ** 2) like in Python
+    '**': 75,
+}
+# Operators that group from the right (2 ** 3 ** 2 is 2 ** 9)
+RIGHT_ASSOCIATIVE = {'**'}
+NOT_POWER = 30
+ARITHMETIC_POWER = 45
+UNARY_POWER = 70
+POSTFIX_POWER = 80
+
+def tokenize(text):
+    """Split an expression into (kind, value) tokens"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_PATTERN.match(text, pos)
+        if not match:
+            raise ExpressionError(f"Unexpected character {text[pos:].strip()[0]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'num':
+            value = float(value) if '.' in value else int(value)
+        tokens.append((kind, value))
+    tokens.append(('end', None))
+    return tokens
+
+class ExpressionParser:
+    """Pratt parser turning Sifzz expressions into plain tuple trees.
+
+    Nodes are ('const', value), ('var', name), ('neg', x), ('not', x),
+    ('binop', op, left, right), ('and', left, right), ('or', left, right),
+    ('contains', container, item), ('call', name, args), ('upper', x),
+    ('lower', x), ('length', x) and ('random', low, high). Trees only hold
+    strings, numbers and tuples so they can be stored and reused.
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        node = self.expression(0)
+        if self.peek()[0] != 'end':
+            raise ExpressionError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def is_word(self, word, offset=0):
+        return self.peek(offset) == ('name', word)
+
+    def expect_word(self, word):
+        if not self.is_word(word):
+            raise ExpressionError(f"Expected '{word}'")
+        self.pos += 1
+
+    def expect_op(self, op):
+        if self.peek() != ('op', op):
+            raise ExpressionError(f"Expected '{op}'")
+        self.pos += 1
+
+    def expression(self, power):
+        left = self.prefix()
+        while True:
+            op, width = self.infix_operator()
+            if op is None:
+                break
+            if op in ('uppercase', 'lowercase'):
+                if POSTFIX_POWER <= power:
+                    break
+                self.pos += width
+                left = ('upper' if op == 'uppercase' else 'lower', left)
+                continue
+            op_power = BINARY_POWER[op]
+            if op_power <= power:
+                break
+            self.pos += width
+            right = self.expression(op_power - 1 if op in RIGHT_ASSOCIATIVE else op_power)
+            if op in ('and', 'or'):
+                left = (op, left, right)
+            elif op == 'contains':
+                left = ('contains', left, right)
+            else:
+                left = ('binop', op, left, right)
+        return left
+
+    def infix_operator(self):
+        """Return the operator at the current position and its token width"""
+        kind, value = self.peek()
+        if kind == 'op' and value in BINARY_POWER:
+            return value, 1
+        if kind != 'name':
+            return None, 0
+        if value in ('and', 'or', 'contains', 'uppercase', 'lowercase'):
+            return value, 1
+        if value == 'equals':
+            return '==', 1
+        if value == 'is':
+            if self.is_word('not', 1):
+                return '!=', 2
+            for word in ('greater', 'less'):
+                if self.is_word(word, 1):
+                    return self.comparison(word, 2)
+            return '==', 1
+        if value in ('greater', 'less'):
+            return self.comparison(value, 1)
+        return None, 0
+
+    def comparison(self, word, offset):
+        """Read 'greater than [or equal to]' / 'less than [or equal to]'"""
+        if not self.is_word('than', offset):
+            raise ExpressionError(f"Expected 'than' after '{word}'")
+        or_equal = (
+            self.is_word('or', offset + 1)
+            and self.is_word('equal', offset + 2)
+            and self.is_word('to', offset + 3)
+        )
+        if word == 'greater':
+            op = '>=' if or_equal else '>'
+        else:
+            op = '<=' if or_equal else '<'
+        return op, offset + (4 if or_equal else 1)
+
+    def prefix(self):
+        kind, value = self.next()
+        if kind in ('num', 'str'):
+            return ('const', value)
+        if kind == 'op':
+            if value == '(':
+                node = self.expression(0)
+                self.expect_op(')')
+                return node
+            if value == '-':
+                operand = self.expression(UNARY_POWER)
+                if operand[0] == 'const' and not isinstance(operand[1], str):
+                    return ('const', -operand[1])
+                return ('neg', operand)
+            if value == '+':
+                return self.expression(UNARY_POWER)
+            raise ExpressionError(f"Unexpected {value!r}")
+        if kind == 'name':
+            return self.name(value)
+        raise ExpressionError("Unexpected end of expression")
+
+    def name(self, word):
+        if word == 'true':
+            return ('const', True)
+        if word == 'false':
+            return ('const', False)
+        if word == 'not':
+            return ('not', self.expression(NOT_POWER))
+        if word == 'length' and self.is_word('of'):
+            self.pos += 1
+            return ('length', self.expression(POSTFIX_POWER))
+        if word == 'random' and self.is_word('number') and self.is_word('between', 1):
+            self.pos += 2
+            low = self.expression(ARITHMETIC_POWER)
+            self.expect_word('and')
+            high = self.expression(ARITHMETIC_POWER)
+            return ('random', low, high)
+        if self.peek() == ('op', '('):
+            if word not in BUILTIN_FUNCTIONS:
+                raise ExpressionError(f"Unknown function '{word}'")
+            self.pos += 1
+            args = []
+            if self.peek() != ('op', ')'):
+                args.append(self.expression(0))
+                while self.peek() == ('op', ','):
+                    self.pos += 1
+                    args.append(self.expression(0))
+            self.expect_op(')')
+            return ('call', word, tuple(args))
+        return ('var', word)
+
+def parse_expression(text):
+    """Parse an expression, falling back to its raw text if it is not valid.
+
+    Unparseable expressions evaluate to their own text, which is how plain
+    words after `say` have always behaved.
+    """
+    text = text.strip()
+    try:
+        return ExpressionParser(text).parse()
+    except ExpressionError:
+        return ('raw', text)
+
+def parse_condition(text):
+    """Parse a condition - invalid conditions are always false"""
+    node = parse_expression(text)
+    if node[0] == 'raw':
+        return ('const', False)
+    return node
+
+def to_text(value):
+    """Convert a value to the text Sifzz shows for it"""
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if type(value) is array:
+        return str(value.tolist())
+    return str(value)
+
+def add_values(left, right):
+    """Sifzz `+`: numeric addition, otherwise text concatenation"""
+    try:
+        return left + right
+    except TypeError:
+        return to_text(left) + to_text(right)
+
+def length_of(value):
+    """Sifzz `length of`: text and collection length, or the length of the
+    text of any other value"""
+    if isinstance(value, (list, str, set, dict, array)):
+        return len(value)
+    return len(to_text(value))
+
+# `set x to ... of list` commands, each a single call over the whole list
+AGGREGATES = {
+    'sum': sum,
+    'max': max,
+    'min': min,
+}
+
+def loop_items(collection):
+    """What a for each loop goes through: a list or number array itself
+    (not a copy, so big lists cost nothing extra), or a snapshot of a set's
+    items or a map's keys, since those can't change while they are looped
+    over"""
+    if type(collection) is list or type(collection) is array:
+        return collection
+    return list(collection)
+
+def contains_value(container, item):
+    if isinstance(container, str) and not isinstance(item, str):
+        item = to_text(item)
+    return item in container
+
+BINARY_FUNCTIONS = {
+    '+': add_values,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+# Folding won't build text longer than this at compile time
+MAX_FOLDED_LENGTH = 4096
+# ...or raise a number to a bigger power than this
+MAX_FOLDED_EXPONENT = 64
+
+UNARY_FUNCTIONS = {
+    'neg': operator.neg,
+    'not': operator.not_,
+    'upper': lambda value: to_text(value).upper(),
+    'lower': lambda value: to_text(value).lower(),
+    'length': length_of,
+}
+
+def fold_constants(node):
+    """Evaluate every part of an expression tree that only uses constants.
+    
+    Parts that would fail at runtime (like dividing by zero) are left alone
+    so that they still give the usual fallback value when they run.
+    """
+    kind = node[0]
+    if kind in ('const', 'var', 'raw'):
+        return node
+    
+    if kind in ('and', 'or'):
+        left, right = fold_constants(node[1]), fold_constants(node[2])
+        if left[0] == 'const':
+            # `a and b` gives a when a is false, otherwise b (and the other
+            # way round for or)
+            return right if bool(left[1]) == (kind == 'and') else left
+        return (kind, left, right)
+    
+    if kind == 'binop':
+        op = node[1]
+        args = (fold_constants(node[2]), fold_constants(node[3]))
+        folded = ('binop', op, *args)
+        fn = BINARY_FUNCTIONS[op]
+    elif kind == 'call':
+        args = tuple(fold_constants(arg) for arg in node[2])
+        folded = ('call', node[1], args)
+        fn = BUILTIN_FUNCTIONS[node[1]]
+    elif kind == 'contains':
+        args = (fold_constants(node[1]), fold_constants(node[2]))
+        folded = ('contains', *args)
+        fn = contains_value
+    elif kind in UNARY_FUNCTIONS:
+        args = (fold_constants(node[1]),)
+        folded = (kind, *args)
+        fn = UNARY_FUNCTIONS[kind]
+    else:
+        # random number between ... has to run every time
+        return (kind, *(fold_constants(arg) for arg in node[1:]))
+    
+    if not all(arg[0] == 'const' for arg in args):
+        return folded
+    values = [arg[1] for arg in args]
+    if fn is operator.mul and any(isinstance(value, str) for value in values):
+        # Don't build huge repeated text
+        text, count = values if isinstance(values[0], str) else values[::-1]
+        if not isinstance(count, int) or len(text) * count > MAX_FOLDED_LENGTH:
+            return folded
+    if fn is operator.pow and not (isinstance(values[1], (int, float)) and abs(values[1]) <= MAX_FOLDED_EXPONENT):
+        return folded
+    try:
+        value = fn(*values)
+    except Exception:
+        return folded
+    if isinstance(value, str) and len(value) > MAX_FOLDED_LENGTH:
+        return folded
+    return ('const', value)
+
+def expression_text(node, power=0):
+    """Turn an expression tree back into Sifzz source text.
+    
+    This is what an expression that fails to evaluate gives instead, the
+    same way the old eval()-based evaluator gave back its text.
+    """
+    kind = node[0]
+    if kind == 'const':
+        value = node[1]
+        return f'"{value}"' if isinstance(value, str) else to_text(value)
+    if kind in ('var', 'raw'):
+        return node[1]
+    if kind in ('binop', 'and', 'or', 'contains'):
+        if kind == 'binop':
+            op, left, right = node[1:]
+        else:
+            op, left, right = kind, node[1], node[2]
+        op_power = BINARY_POWER[op]
+        left_power, right_power = (op_power, op_power - 1) if op in RIGHT_ASSOCIATIVE else (op_power - 1, op_power)
+        text = f'{expression_text(left, left_power)} {op} {expression_text(right, right_power)}'
+        return f'({text})' if op_power <= power else text
+    if kind == 'neg':
+        return '-' + expression_text(node[1], UNARY_POWER)
+    if kind == 'not':
+        text = 'not ' + expression_text(node[1], NOT_POWER)
+        return f'({text})' if NOT_POWER <= power else text
+    if kind == 'call':
+        return f"{node[1]}({', '.join(expression_text(arg) for arg in node[2])})"
+    if kind in ('upper', 'lower'):
+        return f"{expression_text(node[1], POSTFIX_POWER)} {kind}case"
+    if kind == 'length':
+        return 'length of ' + expression_text(node[1], POSTFIX_POWER)
+    if kind == 'random':
+        return f'random number between {expression_text(node[1], ARITHMETIC_POWER)} and {expression_text(node[2], ARITHMETIC_POWER)}'
+    return str(node)
+
+def count_nodes(node):
+    """Number of nodes in an expression tree"""
+    if node[0] == 'call':
+        return 1 + sum(count_nodes(arg) for arg in node[2])
+    return 1 + sum(count_nodes(arg) for arg in node[1:] if type(arg) is tuple)
+
+class ExpressionCompiler:
+    """Turns expression trees into closures bound to an interpreter.
+
+    Variable names are resolved to slots of the interpreter's VariableFrame
+    when a tree is compiled; names that are not set when the closure runs
+    resolve to a list of that name, or to the name itself.
+    """
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+
+    def compile(self, node, fallback=None):
+        """Compile a tree into a zero-argument function.
+
+        Evaluation errors make the function return `fallback` (the
+        expression's own text if it is None) instead of raising, the same
+        way the old eval()-based evaluator behaved. In debug mode both that
+        and text that is not an expression print a warning.
+        """
+        fn = self.build(node)
+        if node[0] == 'raw' and DEBUG_MODE:
+            self.interpreter.output.write(f"[WARNING] Not an expression, using it as text: {node[1]}\n")
+        if node[0] in ('const', 'var', 'raw'):
+            return fn
+        
+        text = expression_text(node)
+        if fallback is None:
+            fallback = text
+        output = self.interpreter.output
+
+        def guarded():
+            try:
+                return fn()
+            except RecursionError:
+                # Too deep to carry on, see SifzzInterpreter.run
+                raise
+            except Exception as e:
+                if DEBUG_MODE:
+                    output.write(f"[WARNING] Could not evaluate {text}: {e}\n")
+                return fallback
+        return guarded
+
+    def build(self, node):
+        return getattr(self, 'build_' + node[0])(*node[1:])
+
+    def build_const(self, value):
+        return lambda: value
+
+    def build_raw(self, text):
+        return lambda: text
+
+    def build_var(self, name):
+        values = self.interpreter.variables.values
+        slot = self.interpreter.variables.slot(name)
+        lists = self.interpreter.lists
+
+        def read():
+            value = values[slot]
+            if value is UNSET or type(value) is TextBuilder:
+                return read_slot(values, slot, name, lists)
+            return value
+        return read
+
+    def build_neg(self, operand):
+        operand = self.build(operand)
+        return lambda: -operand()
+
+    def build_not(self, operand):
+        operand = self.build(operand)
+        return lambda: not operand()
+
+    def build_and(self, left, right):
+        left, right = self.build(left), self.build(right)
+        return lambda: left() and right()
+
+    def build_or(self, left, right):
+        left, right = self.build(left), self.build(right)
+        return lambda: left() or right()
+
+    def build_binop(self, op, left, right):
+        fn = BINARY_FUNCTIONS[op]
+        left_fn = self.build(left)
+        if right[0] == 'const':
+            constant = right[1]
+            return lambda: fn(left_fn(), constant)
+        right_fn = self.build(right)
+        return lambda: fn(left_fn(), right_fn())
+
+    def build_contains(self, container, item):
+        container, item = self.build(container), self.build(item)
+        return lambda: contains_value(container(), item())
+
+    def build_call(self, name, args):
+        fn = BUILTIN_FUNCTIONS[name]
+        args = [self.build(arg) for arg in args]
+        if len(args) == 1:
+            arg = args[0]
+            return lambda: fn(arg())
+        return lambda: fn(*[arg() for arg in args])
+
+    def build_upper(self, operand):
+        operand = self.build(operand)
+        return lambda: to_text(operand()).upper()
+
+    def build_lower(self, operand):
+        operand = self.build(operand)
+        return lambda: to_text(operand()).lower()
+
+    def build_length(self, operand):
+        operand = self.build(operand)
+        return lambda: length_of(operand())
+
+    def build_random(self, low, high):
+        low, high = self.build(low), self.build(high)
+        randint = self.interpreter.random.randint
+        return lambda: randint(int(low()), int(high()))
+
+class ExpressionCache:
+    """Bounded LRU cache of compiled expressions keyed by their source text.
+
+    Used for text that reaches the interpreter at runtime (modules calling
+    eval_condition/eval_expression, run_line callbacks), so evaluating the
+    same text again is a dictionary lookup instead of a recompile. Once
+    `max_size` entries are stored the least recently used one is dropped.
+    """
+
+    def __init__(self, name, compile_text, max_size=256):
+        self.name = name
+        self.compile_text = compile_text
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        entries = self.entries
+        try:
+            compiled = entries[text]
+        except KeyError:
+            self.misses += 1
+            compiled = self.compile_text(text)
+            entries[text] = compiled
+            if len(entries) > self.max_size:
+                entries.popitem(last=False)
+            if DEBUG_MODE:
+                print(f"[DEBUG] Compiled {self.name} '{text}' ({self.stats()})")
+            return compiled
+        self.hits += 1
+        entries.move_to_end(text)
+        return compiled
+
+    def stats(self):
+        return f"{self.name} cache: {self.hits} hits, {self.misses} misses, {len(self.entries)}/{self.max_size} entries"
+
+#################
+### Variables ###
+#################
+
+# Marks a variable slot that has not been assigned
+UNSET = object()
+
+class TextBuilder:
+    """Text that a script is building up with `add ... to`.
+    
+    Adding to a text variable appends to a list of chunks instead of
+    copying the whole text every time, which made building long text
+    quadratic. The chunks are joined the first time the variable is read
+    and the text replaces the builder in its slot, so nothing that reads
+    variables (expressions, modules, hooks) ever sees a TextBuilder.
+    """
+    
+    __slots__ = ('chunks',)
+    
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+def join_text(values, slot):
+    """Read a slot, joining the text being built in it if there is any"""
+    value = values[slot]
+    if type(value) is TextBuilder:
+        value = values[slot] = ''.join(value.chunks)
+    return value
+
+def read_slot(values, slot, name, lists):
+    """Read a variable that is unset or being built: unset names read as
+    the list with that name, or the name itself"""
+    value = values[slot]
+    if value is UNSET:
+        return lists.get(name, name)
+    return join_text(values, slot)
+
+def append_value(current, value):
+    """`add value to variable` for a variable that is set"""
+    if type(current) is TextBuilder:
+        current.chunks.append(to_text(value))
+        return current
+    if type(current) is str:
+        # Text plus anything is text; keep the pieces until it is read
+        return TextBuilder(current, to_text(value))
+    return add_values(current, value)
+
+class VariableFrame(MutableMapping):
+    """Variables stored in a flat list of slots.
+
+    Compiled code resolves every variable name to a slot number once, when
+    it is linked, and then reads and writes `values[slot]` directly. `names`
+    maps each name to its slot. The frame still behaves like the old
+    name -> value dictionary, so modules can keep using
+    `interpreter.variables[name]`.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.values = []
+        # Called as on_write(name, value) when set through the mapping
+        # interface, see HookManager
+        self.on_write = None
+
+    def slot(self, name):
+        """Return the slot for a name, allocating one on first use"""
+        try:
+            return self.names[name]
+        except KeyError:
+            slot = self.names[name] = len(self.values)
+            self.values.append(UNSET)
+            return slot
+
+    def __getitem__(self, name):
+        slot = self.names.get(name)
+        if slot is None or self.values[slot] is UNSET:
+            raise KeyError(name)
+        return join_text(self.values, slot)
+
+    def __setitem__(self, name, value):
+        self.values[self.slot(name)] = value
+        if self.on_write is not None:
+            self.on_write(name, value)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.values[self.names[name]] = UNSET
+
+    def __contains__(self, name):
+        slot = self.names.get(name)
+        return slot is not None and self.values[slot] is not UNSET
+
+    def __iter__(self):
+        values = self.values
+        return iter([name for name, slot in self.names.items() if values[slot] is not UNSET])
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not UNSET)
+
+    def get(self, name, default=None):
+        slot = self.names.get(name)
+        if slot is None or self.values[slot] is UNSET:
+            return default
+        return join_text(self.values, slot)
+
+    def clear(self):
+        # Slots stay allocated because compiled code refers to them
+        self.values[:] = [UNSET] * len(self.values)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class Function:
+    """A user-defined function, collected when the script is compiled.
+    
+    Parameters live in ordinary variable slots and are bound with shallow
+    binding: a call saves the caller's values of the parameter slots in a
+    frame, stores the arguments, runs the body and puts the saved values
+    back. Frames are plain lists that are reused, so recursive calls don't
+    allocate a new scope each time.
+    """
+    
+    __slots__ = ('name', 'nodes', 'start', 'end', 'params', 'frames')
+    
+    def __init__(self, name, nodes, start, end, params):
+        self.name = name
+        self.nodes = nodes
+        self.start = start
+        self.end = end
+        self.params = params
+        self.frames = []
+    
+    def call(self, interpreter, args):
+        params = self.params
+        if not params:
+            interpreter.execute_block(self.nodes, self.start, self.end)
+            return
+        
+        values = interpreter.values
+        frame = self.frames.pop() if self.frames else [UNSET] * len(params)
+        for n, slot in enumerate(params):
+            frame[n] = values[slot]
+            values[slot] = args[n] if n < len(args) else UNSET
+        try:
+            interpreter.execute_block(self.nodes, self.start, self.end)
+        finally:
+            for n, slot in enumerate(params):
+                values[slot] = frame[n]
+                frame[n] = UNSET
+            self.frames.append(frame)
+
+# Python recursion limit used while running scripts
+RECURSION_LIMIT = 20000
+
+#####################
+### Number Arrays ###
+#####################
+
+# Number arrays are array('d') objects kept with the lists: 8 bytes per
+# number, and adding to them is as cheap as adding to a list. Operations
+# on a whole array run through NumPy when it is installed (on a view of
+# the same memory, so nothing is copied) and through map() otherwise.
+
+# Arithmetic on arrays, by the symbol of the command
+ARRAY_ARITHMETIC = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+# Comparison words of `set mask to array a ... x`, and their operator
+ARRAY_COMPARISONS = {
+    'is': '==',
+    'equals': '==',
+    'is not': '!=',
+    'greater than': '>',
+    'less than': '<',
+    'greater than or equal to': '>=',
+    'less than or equal to': '<=',
+}
+
+_numpy = None
+
+def load_numpy():
+    """Import NumPy the first time an array needs it; None if it is not
+    installed. Scripts without arrays never pay for the import."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+def array_operands(target, operand):
+    """Check the operand of an array operation and return it as something
+    that can be zipped with target"""
+    if type(operand) is array:
+        if len(operand) != len(target):
+            raise ValueError(f"the arrays have different sizes ({len(target)} and {len(operand)})")
+        return operand
+    return itertools.repeat(float(operand), len(target))
+
+def array_arithmetic(op, target, operand):
+    """Apply an arithmetic operator to every number of target, in place.
+    operand is a number or an array of the same size."""
+    fn = ARRAY_ARITHMETIC[op]
+    others = array_operands(target, operand)
+    if op == '/' and (0.0 in operand if type(operand) is array else not float(operand)):
+        raise ValueError("cannot divide by zero")
+    numpy = load_numpy()
+    if numpy is not None and target:
+        view = numpy.frombuffer(target)
+        other = numpy.frombuffer(operand) if type(operand) is array else float(operand)
+        view[:] = fn(view, other)
+    else:
+        target[:] = array('d', map(fn, target, others))
+
+def array_compare(op, target, operand):
+    """A new array with 1 where the comparison holds and 0 where not"""
+    fn = BINARY_FUNCTIONS[op]
+    others = array_operands(target, operand)
+    numpy = load_numpy()
+    if numpy is not None and target:
+        view = numpy.frombuffer(target)
+        other = numpy.frombuffer(operand) if type(operand) is array else float(operand)
+        mask = array('d')
+        mask.frombytes(fn(view, other).astype(numpy.float64).tobytes())
+        return mask
+    return array('d', map(fn, target, others))
+
+def array_aggregate(name, target):
+    """sum, max or min of an array"""
+    numpy = load_numpy()
+    if numpy is not None and target:
+        return float(getattr(numpy.frombuffer(target), name)())
+    return AGGREGATES[name](target)
+
+def sort_array(target):
+    numpy = load_numpy()
+    if numpy is not None and target:
+        numpy.frombuffer(target).sort()
+    else:
+        target[:] = array('d', sorted(target))
+
+##############
+### Output ###
+##############
+
+class OutputBuffer:
+    """Where say, write and newline send their text.
+
+    Text is collected in a list of chunks and written to sys.stdout in one
+    go once `size` characters are waiting, which saves a print() call (and
+    usually a system call) per line when the output is a pipe or a file.
+    With size 0 every write goes straight to sys.stdout, which is what
+    happens on a terminal, where Python's own line buffering applies. The
+    interpreter drains the buffer before anything else can print (module
+    commands, warnings) and flushes it before ask and when the script ends,
+    so the order of the output never changes.
+    """
+
+    DEFAULT_SIZE = 65536
+
+    def __init__(self, size=None):
+        if size is None:
+            isatty = getattr(sys.stdout, 'isatty', None)
+            size = 0 if isatty is None or isatty() else self.DEFAULT_SIZE
+        self.size = size
+        self.chunks = []
+        self.pending = 0
+
+    def write(self, text):
+        if not self.size:
+            sys.stdout.write(text)
+            return
+        self.chunks.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size:
+            self.drain()
+
+    def drain(self):
+        """Hand the waiting text to sys.stdout, so whatever prints next
+        comes after it"""
+        if self.chunks:
+            text = ''.join(self.chunks)
+            self.chunks.clear()
+            self.pending = 0
+            sys.stdout.write(text)
+
+    def flush(self):
+        """Write out everything that is waiting, down to the terminal or
+        file"""
+        self.drain()
+        sys.stdout.flush()
+
+####################
+### Script Cache ###
+####################
+
+class ScriptCache:
+    """On-disk cache of compiled scripts, like __pycache__ for .sfzz files.
+
+    A script's compiled statements are stored in
+    `__sfzzcache__/<name>.sfzc` next to it. Each file records a key made
+    from the source, the interpreter version and the loaded module
+    patterns, plus a checksum of its contents, so stale or corrupt entries
+    are detected and the script is simply compiled again.
+    """
+
+    MAGIC = b'SFZC\x01\n'
+    DIRECTORY = '__sfzzcache__'
+    _interpreter_hash = None
+
+    def __init__(self, filename):
+        script = Path(filename)
+        self.path = script.parent / self.DIRECTORY / (script.stem + '.sfzc')
+
+    @classmethod
+    def interpreter_hash(cls):
+        """Fingerprint of this interpreter's own source"""
+        if cls._interpreter_hash is None:
+            try:
+                cls._interpreter_hash = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+            except OSError:
+                cls._interpreter_hash = ''
+        return cls._interpreter_hash
+
+    def key(self, code, patterns):
+        digest = hashlib.sha256()
+        for part in (SIFZZ_VERSION, sys.implementation.cache_tag or '',
+                     self.interpreter_hash(), '\n'.join(patterns), code):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest().encode('ascii')
+
+    def load(self, key):
+        """Return the cached records for key, or None if missing or stale"""
+        try:
+            data = self.path.read_bytes()
+        except OSError:
+            return None
+
+        header_size = len(self.MAGIC) + len(key)
+        if data[:header_size] != self.MAGIC + key:
+            return None
+        checksum = data[header_size:header_size + 32]
+        payload = data[header_size + 32:]
+        if hashlib.sha256(payload).digest() != checksum:
+            if DEBUG_MODE:
+                print(f"[DEBUG] Script cache {self.path} is corrupt")
+            return None
+        try:
+            return marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key, records):
+        temp_path = None
+        try:
+            payload = marshal.dumps(records)
+            self.path.parent.mkdir(exist_ok=True)
+            # A unique temp file, so runs storing at the same time can't
+            # write into each other's file before it is renamed into place
+            with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix=self.path.stem,
+                                             suffix='.tmp', delete=False) as temp_file:
+                temp_path = Path(temp_file.name)
+                temp_file.write(self.MAGIC + key + hashlib.sha256(payload).digest() + payload)
+            os.replace(temp_path, self.path)
+        except (OSError, ValueError) as e:
+            if temp_path is not None:
+                temp_path.unlink(missing_ok=True)
+            if DEBUG_MODE:
+                print(f"[DEBUG] Could not write script cache {self.path}: {e}")
+
+##################
+### Transpiler ###
+##################
+
+class PythonTranspiler:
+    """Translates a compiled program into the source of one Python function.
+    
+    Control flow becomes Python if/while/for statements, expression trees
+    become Python expressions and common commands become inline Python, so
+    CPython's bytecode interpreter runs the loops instead of execute_block.
+    Module commands call their handler with the match bound at link time.
+    Statement kinds without a translation here call their usual executor,
+    so every program can be transpiled. Sifzz functions become nested
+    Python functions that bind their parameters the same way Function does.
+    
+    Evaluation errors give the same fallback values as the closures from
+    ExpressionCompiler.
+    """
+    
+    # Python operators with the same meaning as the Sifzz ones
+    OPERATORS = {'-', '*', '/', '//', '%', '**', '==', '!=', '<', '>', '<=', '>='}
+    
+    def __init__(self, interpreter, nodes):
+        self.interpreter = interpreter
+        self.nodes = nodes
+        self.lines = []
+        # The if/loop blocks around each generated line and the statement it
+        # came from, for the sampler
+        self.line_statements = []
+        self.current = None
+        self.open_blocks = ()
+        self.namespace = {
+            'UNSET': UNSET,
+            'add_values': add_values,
+            'to_text': to_text,
+            'contains_value': contains_value,
+            'append_value': append_value,
+            'join_text': join_text,
+            'read_slot': read_slot,
+            'TextBuilder': TextBuilder,
+            'length_of': length_of,
+            'loop_items': loop_items,
+            'output': interpreter.output.write,
+            'drain_output': interpreter.output.drain,
+            'random': interpreter.random,
+            'sys': sys,
+            'time': time,
+        }
+        for name, fn in BUILTIN_FUNCTIONS.items():
+            self.namespace['fn_' + name] = fn
+        self.function_names = {}
+    
+    def translate(self):
+        """Return (source, namespace) for a `sifzz_program(interp)` function"""
+        self.emit(0, 'def sifzz_program(interp):')
+        self.emit(1, 'values = interp.values')
+        self.emit(1, 'lists = interp.lists')
+        
+        nodes = self.nodes
+        for i, stmt in enumerate(nodes):
+            if stmt is not None and stmt.kind == 'function':
+                self.function_names[i] = f'function_{i}'
+        for i in self.function_names:
+            self.function(i)
+        
+        self.block(0, len(nodes), 1, False)
+        self.namespace['SIFZZ_LINES'] = tuple(self.line_statements)
+        self.namespace['SIFZZ_FUNCTIONS'] = {
+            code_name: nodes[i].args[0] for i, code_name in self.function_names.items()
+        }
+        return '\n'.join(self.lines) + '\n', self.namespace
+    
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+        self.line_statements.append((self.open_blocks, self.current))
+    
+    def say(self, depth, text):
+        """Emit code that outputs a fixed line of text"""
+        line = text + '\n'
+        self.emit(depth, f'output({line!r})')
+    
+    def constant(self, value):
+        """Name a Python object the generated code needs to reach"""
+        name = f'k{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+    
+    ### Statements ###
+    
+    def block(self, start, end, depth, in_loop):
+        """Translate the statements in nodes[start:end]"""
+        nodes = self.nodes
+        self.emit(depth, 'pass')
+        i = start
+        while i < end:
+            stmt = nodes[i]
+            if stmt is None:
+                i += 1
+                continue
+            
+            kind = stmt.kind
+            self.current = stmt
+            if kind == 'function':
+                i = stmt.end + 1
+                continue
+            if kind not in BLOCK_ENDERS or kind in ('if', 'loop') and stmt.code[0] is None:
+                self.statement(stmt, depth, in_loop)
+                i += 1
+                continue
+            
+            outer_blocks = self.open_blocks
+            self.open_blocks = outer_blocks + (stmt,)
+            if kind == 'if':
+                self.if_block(stmt, depth, in_loop)
+            elif kind == 'loop':
+                self.loop_block(i, stmt, depth)
+            elif kind == 'repeat':
+                self.repeat_block(i, stmt, depth)
+            else:
+                self.foreach_block(i, stmt, depth)
+            self.open_blocks = outer_blocks
+            i = stmt.end + 1
+    
+    def if_block(self, stmt, depth, in_loop):
+        nodes = self.nodes
+        for header, body_end in stmt.branches:
+            branch = nodes[header]
+            self.current = branch
+            if branch.kind == 'else':
+                self.block(header + 1, body_end, depth, in_loop)
+                return
+            if branch.code[0] is None:
+                continue
+            self.guarded(depth, '_c', branch.args[0], False)
+            self.emit(depth, 'if _c:')
+            self.block(header + 1, body_end, depth + 1, in_loop)
+            self.emit(depth, 'else:')
+            depth += 1
+        self.emit(depth, 'pass')
+    
+    def loop_block(self, i, stmt, depth):
+        self.emit(depth, 'while True:')
+        self.guarded(depth + 1, '_c', stmt.args[0], False)
+        self.emit(depth + 1, 'if not _c:')
+        self.emit(depth + 2, 'break')
+        self.block(i + 1, stmt.end, depth + 1, True)
+    
+    def repeat_block(self, i, stmt, depth):
+        self.guarded(depth, '_t', stmt.args[0])
+        self.emit(depth, 'try:')
+        self.emit(depth + 1, '_n = int(_t)')
+        self.emit(depth, 'except (TypeError, ValueError):')
+        self.say(depth + 1, f"[WARNING] Cannot repeat a non-number of times: {stmt.text}")
+        self.emit(depth + 1, '_n = 0')
+        self.emit(depth, 'for _ in range(_n):')
+        self.block(i + 1, stmt.end, depth + 1, True)
+    
+    def foreach_block(self, i, stmt, depth):
+        if len(stmt.code) == 3:
+            slot = stmt.code[0]
+            self.guarded(depth, '_low', stmt.args[1])
+            self.guarded(depth, '_high', stmt.args[2])
+            self.emit(depth, 'try:')
+            self.emit(depth + 1, '_items = range(int(_low), int(_high))')
+            self.emit(depth, 'except (TypeError, ValueError):')
+            self.emit(depth + 1, '_items = ()')
+        else:
+            slot, list_name = stmt.code
+            self.emit(depth, f'_items = loop_items(lists.get({list_name!r}, ()))')
+        self.emit(depth, 'for _item in _items:')
+        self.emit(depth + 1, f'values[{slot}] = _item')
+        self.block(i + 1, stmt.end, depth + 1, True)
+    
+    def function(self, i):
+        """Translate a function body into a nested Python function"""
+        stmt = self.nodes[i]
+        self.current = stmt
+        slots = self.interpreter.functions[stmt.args[0]].params
+        name = self.function_names[i]
+        self.emit(1, f'def {name}(*args):')
+        if slots:
+            saved = ', '.join(f'values[{slot}]' for slot in slots)
+            self.emit(2, f'saved = ({saved},)')
+            for n, slot in enumerate(slots):
+                self.emit(2, f'values[{slot}] = args[{n}] if len(args) > {n} else UNSET')
+            self.emit(2, 'try:')
+            self.block(i + 1, stmt.end, 3, False)
+            self.emit(2, 'finally:')
+            self.emit(3, f'{saved}, = saved')
+        else:
+            self.block(i + 1, stmt.end, 2, False)
+    
+    def statement(self, stmt, depth, in_loop):
+        kind = stmt.kind
+        code = stmt.code
+        emit = self.emit
+        
+        if kind in ('end', 'else', 'elseif', 'if', 'loop', 'function'):
+            return
+        if kind == 'set':
+            self.guarded(depth, '_t', stmt.args[1])
+            emit(depth, f'values[{code[0]}] = _t')
+        elif kind == 'say':
+            self.guarded(depth, '_t', stmt.args[0])
+            emit(depth, "output(to_text(_t) + '\\n')")
+        elif kind == 'say_text':
+            self.say(depth, code[0])
+        elif kind == 'write':
+            self.guarded(depth, '_t', stmt.args[0])
+            emit(depth, 'output(to_text(_t))')
+        elif kind == 'newline':
+            emit(depth, "output('\\n')")
+        elif kind == 'add':
+            slot = code[1]
+            self.guarded(depth, '_t', stmt.args[0])
+            emit(depth, f'if (_l := lists.get({stmt.args[1]!r})) is not None:')
+            emit(depth + 1, 'if type(_l) is list:')
+            emit(depth + 2, '_l.append(_t)')
+            emit(depth + 1, 'else:')
+            emit(depth + 2, f'interp.add_to_collection({self.constant(stmt)}, _l, _t)')
+            emit(depth, f'elif values[{slot}] is UNSET:')
+            emit(depth + 1, f'values[{slot}] = _t')
+            emit(depth, 'else:')
+            emit(depth + 1, f'values[{slot}] = append_value(values[{slot}], _t)')
+        elif kind == 'subtract':
+            slot = code[1]
+            self.guarded(depth, '_t', stmt.args[0])
+            emit(depth, f'if values[{slot}] is not UNSET:')
+            emit(depth + 1, f'values[{slot}] -= _t')
+        elif kind == 'multiply':
+            slot = code[0]
+            self.guarded(depth, '_t', stmt.args[1])
+            emit(depth, f'if values[{slot}] is not UNSET:')
+            emit(depth + 1, f'values[{slot}] = join_text(values, {slot}) * _t')
+        elif kind == 'divide':
+            slot = code[0]
+            self.guarded(depth, '_t', stmt.args[1])
+            emit(depth, f'if values[{slot}] is not UNSET and _t != 0:')
+            emit(depth + 1, f'values[{slot}] /= _t')
+        elif kind in ('increase', 'decrease'):
+            slot = code[0]
+            step = 1 if kind == 'increase' else -1
+            emit(depth, f'_t = values[{slot}]')
+            emit(depth, f'values[{slot}] = {step} if _t is UNSET else _t + {step}')
+        elif kind == 'create_list':
+            emit(depth, f'lists[{code[0]!r}] = []')
+        elif kind in ('break', 'continue'):
+            if in_loop:
+                emit(depth, kind)
+            else:
+                # Leaves the function, and the caller's loop sees the flag
+                emit(depth, 'interp.loop_break = True')
+                if kind == 'continue':
+                    emit(depth, 'interp.loop_continue = True')
+                emit(depth, 'return')
+        elif kind == 'call':
+            self.call(stmt, depth, in_loop)
+        elif kind == 'module':
+            handler, match = code
+            emit(depth, 'drain_output()')
+            emit(depth, 'try:')
+            emit(depth + 1, f'{self.constant(handler)}({self.constant(match)})')
+            emit(depth, 'except Exception as e:')
+            emit(depth + 1, 'interp.report_module_error(e)')
+        elif kind == 'unknown':
+            self.say(depth, f"[WARNING] Unknown command: {stmt.text}")
+        else:
+            executor = self.interpreter.executors[kind]
+            emit(depth, f'{self.constant(executor)}({self.constant(stmt)})')
+    
+    def call(self, stmt, depth, in_loop):
+        function = stmt.code[0]
+        if function is None:
+            self.say(depth, f"[WARNING] Unknown function: {stmt.args[0]}")
+            return
+        
+        index = function.start - 1
+        if function.nodes is not self.nodes:
+            # Defined by another program; run it the usual way
+            self.emit(depth, f'{self.constant(self.interpreter.exec_call)}({self.constant(stmt)})')
+        else:
+            args = []
+            for n, arg in enumerate(stmt.args[1:]):
+                self.guarded(depth, f'_a{n}', arg)
+                args.append(f'_a{n}')
+            self.emit(depth, f'{self.function_names[index]}({", ".join(args)})')
+        
+        # A break or continue outside any loop in the function body stops
+        # the caller's loop too
+        self.emit(depth, 'if interp.loop_break:')
+        if in_loop:
+            self.emit(depth + 1, 'interp.loop_break = False')
+            self.emit(depth + 1, 'if interp.loop_continue:')
+            self.emit(depth + 2, 'interp.loop_continue = False')
+            self.emit(depth + 2, 'continue')
+            self.emit(depth + 1, 'break')
+        else:
+            self.emit(depth + 1, 'return')
+    
+    ### Expressions ###
+    
+    def guarded(self, depth, target, node, fallback=None):
+        """Assign an expression to target, using fallback (or the
+        expression's text) if it fails"""
+        if node[0] in ('const', 'var', 'raw'):
+            self.emit(depth, f'{target} = {self.expression(node)}')
+            return
+        text = expression_text(node)
+        self.emit(depth, 'try:')
+        self.emit(depth + 1, f'{target} = {self.expression(node)}')
+        self.emit(depth, 'except RecursionError:')
+        self.emit(depth + 1, 'raise')
+        if DEBUG_MODE:
+            warning = f'[WARNING] Could not evaluate {text}: '
+            self.emit(depth, 'except Exception as _e:')
+            self.emit(depth + 1, f"output({warning!r} + str(_e) + '\\n')")
+        else:
+            self.emit(depth, 'except Exception:')
+        if fallback is None:
+            fallback = text
+        self.emit(depth + 1, f'{target} = {fallback!r}')
+    
+    def expression(self, node):
+        kind = node[0]
+        if kind in ('const', 'raw'):
+            value = node[1]
+            if isinstance(value, float) and not math.isfinite(value):
+                return self.constant(value)
+            return repr(value)
+        if kind == 'var':
+            name = node[1]
+            slot = self.interpreter.variables.slot(name)
+            return f'(_v if (_v := values[{slot}]) is not UNSET and type(_v) is not TextBuilder else read_slot(values, {slot}, {name!r}, lists))'
+        if kind == 'neg':
+            return f'(-{self.expression(node[1])})'
+        if kind == 'not':
+            return f'(not {self.expression(node[1])})'
+        if kind in ('and', 'or'):
+            return f'({self.expression(node[1])} {kind} {self.expression(node[2])})'
+        if kind == 'binop':
+            op, left, right = node[1:]
+            left, right = self.expression(left), self.expression(right)
+            if op in self.OPERATORS:
+                return f'({left} {op} {right})'
+            return f'add_values({left}, {right})'
+        if kind == 'contains':
+            return f'contains_value({self.expression(node[1])}, {self.expression(node[2])})'
+        if kind == 'call':
+            args = ', '.join(self.expression(arg) for arg in node[2])
+            return f'fn_{node[1]}({args})'
+        if kind == 'upper':
+            return f'to_text({self.expression(node[1])}).upper()'
+        if kind == 'lower':
+            return f'to_text({self.expression(node[1])}).lower()'
+        if kind == 'length':
+            return f'length_of({self.expression(node[1])})'
+        if kind == 'random':
+            return f'random.randint(int({self.expression(node[1])}), int({self.expression(node[2])}))'
+        # Anything else runs through its compiled closure
+        return f'{self.constant(self.interpreter.expressions.compile(node))}()'
+
+################
+### Profiler ###
+################
+
+class Profiler:
+    """Per-line profiler for Sifzz scripts (--profile).
+    
+    Records hit counts and wall time for every source line and every module
+    command handler. Cumulative time includes everything a line runs (a
+    loop's body, a called function); self time leaves out the time of the
+    lines it ran. Profiling replaces execute_statement, the block handlers
+    and the module executor of one interpreter with timing wrappers, so
+    interpreters that are not profiled run exactly the same code as before.
+    """
+    
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.lines = {}     # lineno -> [hits, cumulative, self, text]
+        self.handlers = {}  # handler name -> [calls, time]
+        self.children = []  # time spent in lines run by each active line
+        self.active = {}    # lineno -> how many times it is running (recursion)
+        self.started = None
+        self.stopped = None
+    
+    def start(self):
+        interpreter = self.interpreter
+        execute_statement = interpreter.execute_statement
+        interpreter.execute_statement = lambda stmt: self.measure(stmt, execute_statement, stmt)
+        for kind, handler in interpreter.blocks.items():
+            interpreter.blocks[kind] = self.block_wrapper(handler)
+        interpreter.executors['module'] = self.module_wrapper(interpreter.executors['module'])
+        self.started = time.perf_counter()
+    
+    def stop(self):
+        if self.stopped is None:
+            self.stopped = time.perf_counter()
+    
+    def block_wrapper(self, handler):
+        return lambda nodes, start: self.measure(nodes[start], handler, nodes, start)
+    
+    def module_wrapper(self, executor):
+        handlers = self.handlers
+        perf_counter = time.perf_counter
+        
+        def execute_module(stmt):
+            handler = stmt.code[0]
+            name = getattr(handler, '__qualname__', None) or repr(handler)
+            start = perf_counter()
+            try:
+                return executor(stmt)
+            finally:
+                elapsed = perf_counter() - start
+                try:
+                    record = handlers[name]
+                except KeyError:
+                    record = handlers[name] = [0, 0.0, stmt.args[0]]
+                record[0] += 1
+                record[1] += elapsed
+        return execute_module
+    
+    def measure(self, stmt, run, *args):
+        """Run one line and add its time to the line's record"""
+        lineno = stmt.lineno
+        children = self.children
+        active = self.active
+        perf_counter = time.perf_counter
+        
+        children.append(0.0)
+        active[lineno] = active.get(lineno, 0) + 1
+        start = perf_counter()
+        try:
+            return run(*args)
+        finally:
+            elapsed = perf_counter() - start
+            active[lineno] -= 1
+            child_time = children.pop()
+            if children:
+                children[-1] += elapsed
+            try:
+                record = self.lines[lineno]
+            except KeyError:
+                record = self.lines[lineno] = [0, 0.0, 0.0, stmt.text]
+            record[0] += 1
+            record[2] += elapsed - child_time
+            # Only the outermost run of a recursive line counts towards its
+            # cumulative time
+            if not active[lineno]:
+                record[1] += elapsed
+    
+    def total_time(self):
+        return (self.stopped or time.perf_counter()) - (self.started or time.perf_counter())
+    
+    def report(self, file=None, limit=None):
+        """Print the lines sorted by self time, then the module handlers"""
+        file = file or sys.stderr
+        total = self.total_time()
+        hits = sum(record[0] for record in self.lines.values())
+        rows = sorted(self.lines.items(), key=lambda item: item[1][2], reverse=True)
+        if limit:
+            rows = rows[:limit]
+        
+        print(f"\n[PROFILE] {hits} statements in {total:.3f}s", file=file)
+        print(f"{'line':>6} {'hits':>10} {'total ms':>11} {'self ms':>11} {'self %':>7}  source", file=file)
+        for lineno, (count, cumulative, own, text) in rows:
+            percent = 100 * own / total if total else 0.0
+            print(
+                f"{lineno:>6} {count:>10} {cumulative * 1000:>11.3f} {own * 1000:>11.3f} {percent:>6.1f}%  {text[:60]}",
+                file=file
+            )
+        
+        if self.handlers:
+            print(f"\n{'calls':>10} {'total ms':>11}  module handler", file=file)
+            handlers = sorted(self.handlers.items(), key=lambda item: item[1][1], reverse=True)
+            for name, (calls, elapsed, pattern) in handlers:
+                print(f"{calls:>10} {elapsed * 1000:>11.3f}  {name} ({pattern})", file=file)
+    
+    def as_dict(self):
+        return {
+            'total_seconds': self.total_time(),
+            'lines': [
+                {'line': lineno, 'source': text, 'hits': count, 'total_seconds': cumulative, 'self_seconds': own}
+                for lineno, (count, cumulative, own, text) in sorted(self.lines.items())
+            ],
+            'module_handlers': [
+                {'handler': name, 'pattern': pattern, 'calls': calls, 'total_seconds': elapsed}
+                for name, (calls, elapsed, pattern) in sorted(self.handlers.items())
+            ],
+        }
+    
+    def write_json(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+# Statements whose generated lines belong to the block they open
+TRANSPILED_BLOCK_KINDS = {'if', 'elseif', 'else', 'loop', 'repeat', 'foreach', 'function'}
+
+class SamplingProfiler:
+    """Low-overhead sampling profiler (--sample).
+    
+    A background thread looks at the interpreter thread's Python stack every
+    `interval` seconds and turns it into a Sifzz stack: called functions,
+    the if/loop blocks being run, the current statement and the module
+    command handler. The script itself runs unchanged. Stacks are written
+    in the collapsed format ("a;b;c count") that flamegraph.pl, speedscope
+    and similar tools read.
+    """
+    
+    TRANSPILED = '<sifzz transpiled>'
+    
+    def __init__(self, interpreter, interval=0.005):
+        self.interpreter = interpreter
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.thread_id = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        
+        cls = type(interpreter)
+        self.block_codes = {
+            cls.handle_if.__code__,
+            cls.handle_loop.__code__,
+            cls.handle_repeat.__code__,
+            cls.handle_foreach.__code__,
+        }
+        self.statement_code = cls.execute_statement.__code__
+        self.module_code = cls.run_module_command.__code__
+        self.call_code = Function.call.__code__
+    
+    def start(self):
+        """Start sampling the calling thread"""
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.sample_loop, name='sifzz-sampler', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+    
+    def sample_loop(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ';'.join(self.script_stack(frame))
+            del frame
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+    
+    def script_stack(self, frame):
+        """Sifzz-level labels for a Python stack, outermost first"""
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            if code in self.block_codes:
+                local = frame.f_locals
+                labels.append(self.label(local['nodes'][local['start']]))
+            elif code is self.statement_code:
+                labels.append(self.label(frame.f_locals['stmt']))
+            elif code is self.call_code:
+                labels.append(f"function {frame.f_locals['self'].name}")
+            elif code is self.module_code:
+                labels.append(self.module_label(frame.f_locals['stmt']))
+            elif code.co_filename == self.TRANSPILED:
+                blocks, stmt = frame.f_globals['SIFZZ_LINES'][frame.f_lineno - 1]
+                if stmt is not None and stmt.kind == 'module':
+                    labels.append(self.module_label(stmt))
+                # Lines of a block's own header (its condition, the loop
+                # itself) are labelled by the block, like handle_if and co
+                if stmt is not None and stmt.kind not in TRANSPILED_BLOCK_KINDS:
+                    labels.append(self.label(stmt))
+                labels.extend(self.label(block) for block in reversed(blocks))
+                function_name = frame.f_globals['SIFZZ_FUNCTIONS'].get(code.co_name)
+                if function_name is not None:
+                    labels.append(f"function {function_name}")
+            frame = frame.f_back
+        labels.append('sifzz')
+        labels.reverse()
+        return labels
+    
+    def label(self, stmt):
+        return f"{stmt.text} (line {stmt.lineno})".replace(';', ',')
+    
+    def module_label(self, stmt):
+        handler = stmt.code[0]
+        name = getattr(handler, '__qualname__', None) or repr(handler)
+        return f"module {name}"
+    
+    def collapsed(self):
+        """The samples in collapsed stack format, one stack per line"""
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+    
+    def write(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+#############
+### Hooks ###
+#############
+
+# Events hook callbacks can be registered for, and the arguments they get
+HOOK_EVENTS = {
+    'before_statement': '(stmt)',
+    'after_statement': '(stmt)',
+    'before_module_command': '(stmt, handler, match)',
+    'after_module_command': '(stmt, handler, match)',
+    'variable_write': '(name, value)',
+    'condition': '(stmt, result)',
+    'error': '(stmt, error)',
+}
+
+class HookManager:
+    """Instrumentation hooks for tracers, coverage tools and the like.
+    
+    Nothing is hooked until the first callback is registered. Then, like the
+    profiler, the manager wraps execute_statement, the block handlers and
+    the module executor of its interpreter, so scripts that don't use hooks
+    run exactly the same code as before.
+    
+    Block statements (if, loops, function definitions) get before_statement
+    when they start and after_statement once the whole block is done.
+    variable_write is called for variables assigned by statements, for
+    function parameters when they are bound, for each item of a for each
+    loop and for writes through interpreter.variables.
+    condition is called with the result of every if, else if and loop
+    condition; conditions are wrapped when a script is linked, so it only
+    sees scripts compiled after hooks were switched on.
+    A callback that raises is reported and skipped.
+    """
+    
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.callbacks = {event: [] for event in HOOK_EVENTS}
+        self.installed = False
+        self.last_error = None
+        self.module_stmt = None
+    
+    def add(self, event, callback):
+        if event not in self.callbacks:
+            raise ValueError(f"Unknown hook event '{event}' (expected one of: {', '.join(HOOK_EVENTS)})")
+        self.callbacks[event].append(callback)
+        if not self.installed:
+            self.install()
+    
+    def remove(self, event, callback):
+        self.callbacks[event].remove(callback)
+    
+    def only_from(self, owner):
+        """True if every registered callback is a method of owner"""
+        return all(
+            getattr(callback, '__self__', None) is owner
+            for callbacks in self.callbacks.values()
+            for callback in callbacks
+        )
+    
+    def fire(self, event, *args):
+        # Callbacks may print
+        self.interpreter.output.drain()
+        for callback in self.callbacks[event]:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"[WARNING] {event} hook failed: {e}")
+    
+    def install(self):
+        interpreter = self.interpreter
+        self.installed = True
+        
+        execute_statement = interpreter.execute_statement
+        interpreter.execute_statement = lambda stmt: self.run_statement(stmt, execute_statement, stmt)
+        for kind, handler in interpreter.blocks.items():
+            interpreter.blocks[kind] = self.block_wrapper(handler)
+        interpreter.executors['module'] = self.module_wrapper(interpreter.executors['module'])
+        interpreter.executors['call'] = self.call_wrapper(interpreter.executors['call'])
+        
+        # Module errors are caught and printed instead of raised
+        report_module_error = interpreter.report_module_error
+        
+        def report(error):
+            self.report_error(self.module_stmt, error)
+            report_module_error(error)
+        interpreter.report_module_error = report
+        
+        foreach_items = interpreter.foreach_items
+        interpreter.foreach_items = lambda stmt: self.loop_items(stmt, foreach_items(stmt))
+        interpreter.variables.on_write = lambda name, value: self.fire('variable_write', name, value)
+    
+    def block_wrapper(self, handler):
+        return lambda nodes, start: self.run_block(nodes[start], handler, nodes, start)
+    
+    def run_block(self, stmt, run, *args):
+        callbacks = self.callbacks
+        if callbacks['before_statement']:
+            self.fire('before_statement', stmt)
+        try:
+            result = run(*args)
+        except Exception as e:
+            self.report_error(stmt, e)
+            raise
+        if callbacks['after_statement']:
+            self.fire('after_statement', stmt)
+        return result
+    
+    def run_statement(self, stmt, run, *args):
+        positions = VARIABLE_ARGS.get(stmt.kind, ()) if self.callbacks['variable_write'] else ()
+        if not positions:
+            return self.run_block(stmt, run, *args)
+        
+        # Statements like `divide x by 0` or `set x to size of missing` run
+        # without writing anything, so compare with the values from before
+        values = self.interpreter.values
+        before = [values[stmt.code[position]] for position in positions]
+        if stmt.kind == 'add':
+            # Adds to a list, or to the variable (text grows in place)
+            always = stmt.args[1] not in self.interpreter.lists
+        else:
+            always = stmt.kind in ALWAYS_WRITTEN
+        result = self.run_block(stmt, run, *args)
+        for position, old in zip(positions, before):
+            slot = stmt.code[position]
+            if always or values[slot] is not old:
+                value = join_text(values, slot)
+                if value is not UNSET:
+                    self.fire('variable_write', stmt.args[position], value)
+        return result
+    
+    def module_wrapper(self, executor):
+        def execute_module(stmt):
+            handler, match = stmt.code
+            self.fire('before_module_command', stmt, handler, match)
+            outer_stmt, self.module_stmt = self.module_stmt, stmt
+            try:
+                executor(stmt)
+            finally:
+                self.module_stmt = outer_stmt
+            self.fire('after_module_command', stmt, handler, match)
+        return execute_module
+    
+    def call_wrapper(self, executor):
+        variables = self.interpreter.variables
+        
+        def execute_call(stmt):
+            function = stmt.code[0]
+            if function is None or not self.callbacks['variable_write']:
+                return executor(stmt)
+            # The same as exec_call, with the parameters reported as they
+            # are bound (slots are numbered in the order names were added)
+            args = [arg() for arg in stmt.code[1:]]
+            names = list(variables.names)
+            for slot, value in zip(function.params, args):
+                self.fire('variable_write', names[slot], value)
+            function.call(self.interpreter, args)
+        return execute_call
+    
+    def condition_wrapper(self, stmt, condition):
+        callbacks = self.callbacks['condition']
+        
+        def check():
+            result = condition()
+            if callbacks:
+                self.fire('condition', stmt, result)
+            return result
+        return check
+    
+    def loop_items(self, stmt, items):
+        name = stmt.args[0]
+        for item in items:
+            self.fire('variable_write', name, item)
+            yield item
+    
+    def report_error(self, stmt, error):
+        # Errors pass through every enclosing block; only report them once
+        if error is not self.last_error:
+            self.last_error = error
+            self.fire('error', stmt, error)
+
+class DebugTracer:
+    """The statement trace printed in debug mode (-d).
+    
+    Built on the hooks above, so none of it is in the interpreter's own
+    code path: without -d the tracer is never created and nothing is
+    hooked. Each statement is printed with a running count and its line
+    number, conditions with their result and every statement again when
+    it finishes, with how long it (or its whole block) took.
+    """
+    
+    def __init__(self, interpreter):
+        self.count = 0
+        self.running = []
+        hooks = interpreter.hooks
+        hooks.add('before_statement', self.before_statement)
+        hooks.add('after_statement', self.after_statement)
+        hooks.add('condition', self.condition)
+        hooks.add('before_module_command', self.module_command)
+        hooks.add('error', self.error)
+    
+    def before_statement(self, stmt):
+        self.count += 1
+        self.running.append((stmt, self.count, time.perf_counter()))
+        print(f"[DEBUG] #{self.count} line {stmt.lineno}: {stmt.text.strip()}")
+    
+    def after_statement(self, stmt):
+        # Statements that raised never get after_statement; drop them too
+        while self.running:
+            started, number, start = self.running.pop()
+            if started is stmt:
+                print(f"[DEBUG] #{number} done in {(time.perf_counter() - start) * 1000:.3f} ms")
+                return
+    
+    def condition(self, stmt, result):
+        print(f"[DEBUG] Condition '{stmt.text.strip()}' -> {to_text(bool(result))}")
+    
+    def module_command(self, stmt, handler, match):
+        print(f"[DEBUG] Module command handled by {getattr(handler, '__qualname__', handler)}")
+    
+    def error(self, stmt, error):
+        where = f"Line {stmt.lineno}" if stmt is not None else "Module command"
+        print(f"[DEBUG] {where} raised {type(error).__name__}: {error}")
 
 ###################
 ### Interpreter ###
@@ -100,19 +2395,148 @@ class SifzzModule:
 
 class SifzzInterpreter:
     def __init__(self):
-        self.variables = {}
+        self.variables = VariableFrame()
+        self.values = self.variables.values
+        # Each interpreter has its own random numbers, so scripts running
+        # side by side don't share (or reseed) one generator
+        self.random = random.Random()
+        self.bulk_random = None
         self.functions = {}
         self.lists = {}
         self.loop_break = False
         self.loop_continue = False
         self.modules = []
-        self.all_lines = []
+        self.command_sources = []
+        self.imported_files = {}
+        self.program = []
+        self.command_index = CommandIndex()
+        # Debug output is printed as things happen, so the script's own
+        # output can't be held back to go with it
+        self.output = OutputBuffer(0 if DEBUG_MODE else None)
+        self.hooks = HookManager(self)
+        self.expressions = ExpressionCompiler(self)
+        self.expression_cache = ExpressionCache(
+            'expression',
+            lambda text: self.expressions.compile(parse_expression(text))
+        )
+        self.condition_cache = ExpressionCache(
+            'condition',
+            lambda text: self.expressions.compile(parse_condition(text), False)
+        )
+        
+        # First word of a line -> core command parser
+        self.parsers = {
+            'stop': self.parse_exact,
+            'break': self.parse_exact,
+            'continue': self.parse_exact,
+            'newline': self.parse_exact,
+            'exit': self.parse_exact,
+            'flush': self.parse_exact,
+            'end': self.parse_exact,
+            'else': self.parse_else,
+            'else:': self.parse_else,
+            'if': self.parse_if,
+            'loop': self.parse_loop,
+            'repeat': self.parse_repeat,
+            'for': self.parse_for,
+            'function': self.parse_function,
+            'set': self.parse_set,
+            'create': self.parse_create,
+            'add': self.parse_add,
+            'remove': self.parse_remove,
+            'clear': self.parse_clear,
+            'sort': self.parse_sort,
+            'fill': self.parse_fill,
+            'shuffle': self.parse_shuffle,
+            'reverse': self.parse_reverse,
+            'say': self.parse_say,
+            'write': self.parse_write,
+            'wait': self.parse_wait,
+            'subtract': self.parse_subtract,
+            'multiply': self.parse_multiply,
+            'divide': self.parse_divide,
+            'call': self.parse_call,
+            'ask': self.parse_ask,
+            'increase': self.parse_increase,
+            'decrease': self.parse_decrease,
+        }
+        
+        # Statement kind -> executor
+        self.executors = {
+            'stop': self.exec_stop,
+            'exit': self.exec_stop,
+            'break': self.exec_break,
+            'continue': self.exec_continue,
+            'end': self.exec_noop,
+            'else': self.exec_noop,
+            'elseif': self.exec_noop,
+            'if': self.exec_noop,
+            'loop': self.exec_noop,
+            'repeat': self.exec_noop,
+            'foreach': self.exec_noop,
+            'function': self.exec_noop,
+            'unknown': self.exec_unknown,
+            'module': self.exec_module,
+            'set': self.exec_set,
+            'size': self.exec_size,
+            'item': self.exec_item,
+            'random_number': self.exec_random_number,
+            'random_choice': self.exec_random_choice,
+            'seed': self.exec_seed,
+            'sample': self.exec_sample,
+            'fill_random': self.exec_fill_random,
+            'shuffle': self.exec_shuffle,
+            'create_list': self.exec_create_list,
+            'create_set': self.exec_create_set,
+            'create_map': self.exec_create_map,
+            'create_array': self.exec_create_array,
+            'array_op': self.exec_array_op,
+            'array_compare': self.exec_array_compare,
+            'set_key': self.exec_set_key,
+            'add': self.exec_add,
+            'remove': self.exec_remove,
+            'clear': self.exec_clear,
+            'aggregate': self.exec_aggregate,
+            'slice': self.exec_slice,
+            'sort': self.exec_sort,
+            'reverse': self.exec_reverse,
+            'dedupe': self.exec_dedupe,
+            'say': self.exec_say,
+            'say_text': self.exec_say_text,
+            'write': self.exec_write,
+            'newline': self.exec_newline,
+            'flush': self.exec_flush,
+            'wait': self.exec_wait,
+            'subtract': self.exec_subtract,
+            'multiply': self.exec_multiply,
+            'divide': self.exec_divide,
+            'call': self.exec_call,
+            'ask': self.exec_ask,
+            'ask_number': self.exec_ask_number,
+            'increase': self.exec_increase,
+            'decrease': self.exec_decrease,
+        }
+        
+        # Statement kind -> handler for statements that open a block. Each
+        # takes the program and the block's index and returns the index to
+        # continue from
+        self.blocks = {
+            'if': self.handle_if,
+            'loop': self.handle_loop,
+            'repeat': self.handle_repeat,
+            'foreach': self.handle_foreach,
+            'function': self.skip_block,
+        }
+        
+        # Debug tracing runs on the hooks, so it only costs anything with -d
+        self.tracer = DebugTracer(self) if DEBUG_MODE else None
         
         # Load built-in modules
         self.load_builtin_modules()
         
         # Load external modules from modules/ directory
         self.load_external_modules()
+        self.build_command_index()
     
     def load_builtin_modules(self):
         """Load built-in core modules"""
@@ -120,7 +2544,12 @@ class SifzzInterpreter:
         pass
     
     def load_external_modules(self, directory="modules"):
-        """Load external Python modules from directory"""
+        """Load external Python modules from directory.
+        
+        Modules with a COMMANDS manifest are only registered here; they are
+        imported the first time one of their commands runs. Other modules
+        are imported straight away.
+        """
         if DEBUG_MODE:
             print(f"[DEBUG] Looking for modules in: {directory}")
         
@@ -135,7 +2564,7 @@ class SifzzInterpreter:
             print(f"[DEBUG] Found directory: {module_dir}")
         
         # Find all .py files in modules directory
-        py_files = list(module_dir.glob("*.py"))
+        py_files = sorted(module_dir.glob("*.py"))
         if DEBUG_MODE:
             print(f"[DEBUG] Found {len(py_files)} .py files: {[f.name for f in py_files]}")
         
@@ -145,21 +2574,19 @@ class SifzzInterpreter:
                     print(f"[DEBUG] Skipping {module_file.name} (starts with _)")
                 continue
             
+            manifests = read_manifest(module_file)
+            if manifests is not None:
+                for class_name, manifest in manifests:
+                    if DEBUG_MODE:
+                        print(f"[DEBUG] {module_file.name}: {class_name} has {len(manifest)} commands, loading on first use")
+                    self.command_sources.append(LazyModule(self, module_file, class_name, manifest))
+                continue
+            
             if DEBUG_MODE:
                 print(f"[DEBUG] Attempting to load: {module_file.name}")
             
             try:
-                # Load the module dynamically
-                spec = importlib.util.spec_from_file_location(
-                    module_file.stem, 
-                    module_file
-                )
-                module = importlib.util.module_from_spec(spec)
-                if DEBUG_MODE:
-                    print(f"[DEBUG] Executing module: {module_file.stem}")
-                spec.loader.exec_module(module)
-                if DEBUG_MODE:
-                    print(f"[DEBUG] Module executed successfully")
+                module = self.import_module_file(module_file)
                 
                 # Look for SifzzModule classes by checking class names in MRO
                 found_module = False
@@ -174,6 +2601,7 @@ class SifzzInterpreter:
                             # Instantiate and register the module
                             module_instance = item(self)
                             self.modules.append(module_instance)
+                            self.command_sources.append(module_instance)
                             print(f"[INFO] Loaded module: {module_file.stem}")
                             found_module = True
                 
@@ -186,569 +2614,1108 @@ class SifzzInterpreter:
                     import traceback
                     traceback.print_exc()
     
-    def run_file(self, filename):
-        """Run a .sfzz file"""
-        try:
-            with open(filename, 'r') as f:
-                code = f.read()
-            self.run(code)
-        except FileNotFoundError:
-            print(f"Error: File '{filename}' not found")
-            sys.exit(1)
+    def import_module_file(self, module_file):
+        """Import a module file once and return the Python module"""
+        key = str(module_file)
+        if key not in self.imported_files:
+            # Load the module dynamically
+            spec = importlib.util.spec_from_file_location(
+                module_file.stem, 
+                module_file
+            )
+            module = importlib.util.module_from_spec(spec)
+            if DEBUG_MODE:
+                print(f"[DEBUG] Executing module: {module_file.stem}")
+            spec.loader.exec_module(module)
+            if DEBUG_MODE:
+                print(f"[DEBUG] Module executed successfully")
+            self.imported_files[key] = module
+        return self.imported_files[key]
+    
+    def build_command_index(self):
+        """Index every module's patterns, in module load order"""
+        self.command_index = CommandIndex()
+        for module in self.command_sources:
+            for pattern, command_info in module.commands.items():
+                regex = command_info.get('regex') or re.compile(pattern)
+                self.command_index.add(pattern, regex, command_info['handler'])
+    
+    def run_file(self, filename, use_cache=True, transpile=False):
+        """Run a .sfzz file.
+        
+        The compiled script is cached in a __sfzzcache__ directory next to
+        it, so later runs of the same source skip parsing. Pass
+        use_cache=False (or --no-cache on the command line) to always
+        compile from source. transpile=True (--transpile) runs the script
+        as generated Python code instead of with the statement executor.
+        """
+        try:
+            with open(filename, 'r') as f:
+                code = f.read()
+        except FileNotFoundError:
+            print(f"Error: File '{filename}' not found")
+            sys.exit(1)
+        
+        program = None
+        if use_cache:
+            cache = ScriptCache(filename)
+            key = cache.key(code, self.command_index.patterns())
+            program = self.load_program(cache.load(key))
+            if program is None:
+                program = self.compile(code)
+                cache.store(key, self.dump_program(program))
+            elif DEBUG_MODE:
+                print(f"[DEBUG] Loaded compiled script from {cache.path}")
+        self.run(code, program, transpile)
+    
+    def run(self, code, program=None, transpile=False):
+        """Run Sifzz code, optionally already compiled"""
+        self.program = program if program is not None else self.compile(code)
+        if transpile and self.hooks.installed:
+            if self.tracer is not None and self.hooks.only_from(self.tracer):
+                print("[DEBUG] Statement tracing is not available for transpiled scripts")
+            else:
+                print("[WARNING] Hooks are registered, running without --transpile")
+                transpile = False
+        program_function = self.transpile(self.program) if transpile else None
+        # Each Sifzz call nests a few Python calls, so leave room for
+        # recursive functions
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), RECURSION_LIMIT))
+        try:
+            if program_function is not None:
+                program_function(self)
+            else:
+                self.execute_block(self.program, 0, len(self.program))
+        except RecursionError:
+            self.output.drain()
+            print("[ERROR] Too many nested function calls")
+            sys.exit(1)
+        finally:
+            # Also runs for stop script and exit, which raise SystemExit
+            self.output.flush()
+            if DEBUG_MODE:
+                print(f"[DEBUG] {self.condition_cache.stats()}")
+                print(f"[DEBUG] {self.expression_cache.stats()}")
+    
+    def transpile(self, nodes):
+        """Turn a compiled program into a Python function taking the
+        interpreter, or None if the generated code does not compile"""
+        try:
+            source, namespace = PythonTranspiler(self, nodes).translate()
+            exec(compile(source, '<sifzz transpiled>', 'exec'), namespace)
+        except (SyntaxError, RecursionError, MemoryError) as e:
+            # Python limits how deeply blocks can nest
+            if DEBUG_MODE:
+                print(f"[DEBUG] Could not transpile script, running it normally: {e}")
+            return None
+        if DEBUG_MODE:
+            print(f"[DEBUG] Transpiled script to Python:\n{source}")
+        return namespace['sifzz_program']
+    
+    def run_line(self, line):
+        """Execute a single line of Sifzz code (for module callbacks)"""
+        stmt = self.compile_line(line)
+        if stmt is None:
+            return
+        
+        self.execute_statement(stmt)
+        # Callbacks run outside of any script line, e.g. from a GUI event
+        self.output.flush()
+    
+    ###############
+    ### Compile ###
+    ###############
+    
+    def compile(self, code):
+        """Compile Sifzz code into a list of statements, one per source line.
+        
+        Blank lines and comments compile to None so that statement indexes
+        always match line numbers.
+        """
+        nodes = [
+            self.parse_line(line, lineno)
+            for lineno, line in enumerate(code.split('\n'), 1)
+        ]
+        
+        # Work out everything that doesn't depend on runtime values
+        folded = sum(fold_statement(stmt) for stmt in nodes if stmt is not None)
+        match_blocks(nodes)
+        removed = remove_dead_branches(nodes)
+        if DEBUG_MODE:
+            print(f"[DEBUG] Optimizer: folded {folded} expression nodes, removed {removed} unreachable statements")
+        
+        self.link_program(nodes)
+        return nodes
+    
+    def link_program(self, nodes):
+        """Collect the program's functions, then link every statement"""
+        for i, stmt in enumerate(nodes):
+            if stmt is not None and stmt.kind == 'function':
+                name, params = stmt.args[0], stmt.args[1:]
+                self.functions[name] = Function(
+                    name, nodes, i + 1, stmt.end,
+                    tuple(self.variables.slot(param) for param in params)
+                )
+        for stmt in nodes:
+            if stmt is not None:
+                self.link(stmt)
+    
+    def dump_program(self, nodes):
+        """Convert compiled statements into plain data for the script cache"""
+        return tuple(
+            None if stmt is None else
+            (stmt.kind, stmt.args, stmt.lineno, stmt.text, stmt.end, stmt.branches)
+            for stmt in nodes
+        )
+    
+    def load_program(self, records):
+        """Rebuild and link statements from dump_program() data.
+        
+        Returns None if there are no records or they do not describe a
+        program this interpreter can run.
+        """
+        if records is None:
+            return None
+        try:
+            nodes = []
+            for record in records:
+                if record is None:
+                    nodes.append(None)
+                    continue
+                kind, args, lineno, text, end, branches = record
+                if kind not in self.executors:
+                    return None
+                stmt = Statement(kind, args, lineno, text)
+                stmt.end = end
+                stmt.branches = branches
+                nodes.append(stmt)
+            self.link_program(nodes)
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"[DEBUG] Ignoring unusable script cache: {e}")
+            return None
+        return nodes
+    
+    def compile_line(self, line, lineno=0):
+        """Compile a single line - returns None for blank lines and comments"""
+        stmt = self.parse_line(line, lineno)
+        if stmt is not None:
+            fold_statement(stmt)
+            self.link(stmt)
+        return stmt
+    
+    def parse_line(self, line, lineno=0):
+        """Parse a single line without linking it"""
+        line = strip_comment(line)
+        if not line:
+            return None
+        
+        stmt = self.parse_core(line)
+        if stmt is None or has_raw_expression(stmt):
+            # Core commands only claim lines whose expressions they can read
+            module_stmt = self.parse_module_command(line)
+            if stmt is None or module_stmt.kind == 'module':
+                stmt = module_stmt
+        stmt.lineno = lineno
+        stmt.text = line
+        return stmt
+    
+    def link(self, stmt):
+        """Turn a statement's args into runnable code.
+        
+        Expression trees become closures, variable names become slot
+        numbers in self.variables and module commands are bound to their
+        handler and match.
+        """
+        if stmt.kind == 'module':
+            entry = self.command_index.lookup(stmt.args[0])
+            match = entry[0].match(stmt.text) if entry else None
+            if match is None:
+                stmt.kind = 'unknown'
+                stmt.code = ()
+            else:
+                stmt.code = (entry[1], match)
+            return
+        
+        if stmt.kind in ('if', 'elseif', 'loop'):
+            fallback = False
+        else:
+            fallback = None
+        variable_args = VARIABLE_ARGS.get(stmt.kind, ())
+        code = []
+        for n, arg in enumerate(stmt.args):
+            if type(arg) is tuple:
+                arg = self.expressions.compile(arg, fallback)
+            elif n in variable_args:
+                arg = self.variables.slot(arg)
+            code.append(arg)
+        if stmt.kind == 'call':
+            # Calls are bound straight to the function they run
+            code[0] = self.functions.get(code[0])
+        elif fallback is not None and code[0] is not None and self.hooks.installed:
+            code[0] = self.hooks.condition_wrapper(stmt, code[0])
+        stmt.code = tuple(code)
+    
+    def parse_module_command(self, line):
+        """Resolve a line against the loaded modules"""
+        found = self.command_index.match(line)
+        if found is None:
+            return Statement('unknown')
+        return Statement('module', (found[1].re.pattern,))
+    
+    def parse_core(self, line):
+        """Parse a core command - returns None if the line is not one"""
+        parser = self.parsers.get(line.split(' ', 1)[0])
+        if parser is None:
+            return None
+        return parser(line)
+    
+    def parse_exact(self, line):
+        """Commands that are a whole line on their own"""
+        kind = EXACT_COMMANDS.get(line)
+        if kind is None:
+            return None
+        if kind == 'end':
+            return Statement('end', (line,))
+        return Statement(kind)
+    
+    def parse_else(self, line):
+        if line == 'else:':
+            return Statement('else')
+        if line.startswith('else if '):
+            match = RE_ELSE_IF.match(line)
+            return Statement('elseif', (parse_condition(match.group(1)) if match else None,))
+        return None
+    
+    def parse_if(self, line):
+        match = RE_IF.match(line)
+        return Statement('if', (parse_condition(match.group(1)) if match else None,))
+    
+    def parse_loop(self, line):
+        match = RE_LOOP_WHILE.match(line)
+        return Statement('loop', (parse_condition(match.group(1)) if match else None,))
+    
+    def parse_repeat(self, line):
+        match = RE_REPEAT.match(line)
+        if match:
+            return Statement('repeat', (parse_expression(match.group(1)),))
+        return None
+    
+    def parse_for(self, line):
+        match = RE_FOR_EACH.match(line)
+        if not match:
+            return None
+        var_name, source = match.groups()
+        
+        # for each i in range(low, high) counts without building a list
+        range_match = RE_RANGE.match(source)
+        if range_match:
+            bounds = split_arguments(range_match.group(1))
+            if len(bounds) == 2:
+                return Statement('foreach', (var_name, *(parse_expression(bound) for bound in bounds)))
+        return Statement('foreach', (var_name, source.strip()))
+    
+    def parse_function(self, line):
+        match = RE_FUNCTION.match(line)
+        if not match:
+            return None
+        name, params = match.groups()
+        params = split_arguments(params) if params else []
+        if not all(param.isidentifier() for param in params):
+            return None
+        return Statement('function', (name, *params))
+    
+    def parse_set(self, line):
+        if ' to ' not in line:
+            return None
+        
+        # Compare every number of an array
+        match = RE_SET_ARRAY_COMPARE.match(line)
+        if match:
+            target, array_name, comparison, operand = match.groups()
+            return Statement('array_compare', (
+                target, ARRAY_COMPARISONS[comparison], array_name, *self.array_operand(operand)
+            ))
+        
+        # Store a value in a map
+        match = RE_SET_KEY.match(line)
+        if match:
+            key, map_name, value = match.groups()
+            return Statement('set_key', (parse_expression(key), map_name, parse_expression(value)))
+        
+        # Get list size
+        match = RE_SET_SIZE.match(line)
+        if match:
+            return Statement('size', match.groups())
+        
+        # Get list item
+        match = RE_SET_ITEM.match(line)
+        if match:
+            var_name, index, list_name = match.groups()
+            return Statement('item', (var_name, parse_expression(index), list_name))
+        
+        # Sum, max or min of a list
+        match = RE_SET_AGGREGATE.match(line)
+        if match:
+            return Statement('aggregate', match.groups())
+        
+        # Part of a list
+        match = RE_SET_ITEMS.match(line)
+        if match:
+            target, start, end, list_name = match.groups()
+            return Statement('slice', (target, parse_expression(start), parse_expression(end), list_name))
+        
+        # Seed this interpreter's random numbers
+        match = RE_SET_RANDOM_SEED.match(line)
+        if match:
+            return Statement('seed', (parse_expression(match.group(1)),))
+        
+        # Random items of a list
+        match = RE_SET_SAMPLE.match(line)
+        if match:
+            target, count, list_name = match.groups()
+            return Statement('sample', (target, parse_expression(count), list_name))
+        
+        # Random number
+        match = RE_SET_RANDOM_NUMBER.match(line)
+        if match:
+            var_name, low, high = match.groups()
+            return Statement('random_number', (var_name, parse_expression(low), parse_expression(high)))
+        
+        # Random choice
+        match = RE_SET_RANDOM_CHOICE.match(line)
+        if match:
+            return Statement('random_choice', match.groups())
+        
+        match = RE_SET.match(line)
+        if match:
+            return Statement('set', (match.group(1), parse_expression(match.group(2))))
+        return None
+    
+    def parse_create(self, line):
+        if line.startswith('create list '):
+            return Statement('create_list', (line.split()[2],))
+        if line.startswith('create set '):
+            return Statement('create_set', (line.split()[2],))
+        if line.startswith('create map '):
+            return Statement('create_map', (line.split()[2],))
+        match = RE_CREATE_ARRAY.match(line)
+        if match:
+            return Statement('create_array', match.groups())
+        return None
+    
+    def parse_array_op(self, op, array_name, operand):
+        return Statement('array_op', (op, array_name, *self.array_operand(operand)))
+    
+    def array_operand(self, text):
+        """(array name, None) for `array NAME`, else (None, expression)"""
+        match = RE_ARRAY_OPERAND.match(text.strip())
+        if match:
+            return (match.group(1), None)
+        return (None, parse_expression(text))
+    
+    def parse_add(self, line):
+        match = RE_ARRAY_ADD.match(line)
+        if match:
+            return self.parse_array_op('+', match.group(2), match.group(1))
+        
+        match = RE_ADD.match(line)
+        if match:
+            return Statement('add', (parse_expression(match.group(1)), match.group(2)))
+        return None
+    
+    def parse_remove(self, line):
+        match = RE_REMOVE_DUPLICATES.match(line)
+        if match:
+            return Statement('dedupe', match.groups())
+        
+        match = RE_REMOVE.match(line)
+        if match:
+            return Statement('remove', (parse_expression(match.group(1)), match.group(2)))
+        return None
+    
+    def parse_clear(self, line):
+        return self.parse_named('clear', line)
+    
+    def parse_fill(self, line):
+        match = RE_FILL_RANDOM.match(line)
+        if match:
+            list_name, count, low, high = match.groups()
+            return Statement('fill_random', (list_name, *(parse_expression(part) for part in (count, low, high))))
+        return None
+    
+    def parse_shuffle(self, line):
+        match = RE_SHUFFLE.match(line)
+        if match:
+            return Statement('shuffle', match.groups())
+        return None
+    
+    def parse_sort(self, line):
+        match = RE_SORT.match(line)
+        if match:
+            return Statement('sort', match.groups())
+        return None
+    
+    def parse_reverse(self, line):
+        match = RE_REVERSE.match(line)
+        if match:
+            return Statement('reverse', match.groups())
+        return None
+    
+    def parse_say(self, line):
+        return Statement('say', (parse_expression(line[4:]),))
+    
+    def parse_write(self, line):
+        return Statement('write', (parse_expression(line[6:]),))
+    
+    def parse_wait(self, line):
+        match = RE_WAIT.match(line)
+        if match:
+            return Statement('wait', (float(match.group(1)),))
+        return None
+    
+    def parse_subtract(self, line):
+        match = RE_ARRAY_SUBTRACT.match(line)
+        if match:
+            return self.parse_array_op('-', match.group(2), match.group(1))
+        
+        match = RE_SUBTRACT.match(line)
+        if match:
+            return Statement('subtract', (parse_expression(match.group(1)), match.group(2)))
+        return None
+    
+    def parse_multiply(self, line):
+        match = RE_ARRAY_MULTIPLY.match(line)
+        if match:
+            return self.parse_array_op('*', *match.groups())
+        
+        match = RE_MULTIPLY.match(line)
+        if match:
+            return Statement('multiply', (match.group(1), parse_expression(match.group(2))))
+        return None
+    
+    def parse_divide(self, line):
+        match = RE_ARRAY_DIVIDE.match(line)
+        if match:
+            return self.parse_array_op('/', *match.groups())
+        
+        match = RE_DIVIDE.match(line)
+        if match:
+            return Statement('divide', (match.group(1), parse_expression(match.group(2))))
+        return None
     
-    def run(self, code):
-        """Run Sifzz code"""
-        self.all_lines = code.split('\n')
-        self.execute_block(self.all_lines, 0, len(self.all_lines))
+    def parse_call(self, line):
+        match = RE_CALL.match(line)
+        if not match:
+            return None
+        name, args = match.groups()
+        args = split_arguments(args) if args else []
+        return Statement('call', (name, *(parse_expression(arg) for arg in args)))
     
-    def run_line(self, line):
-        """Execute a single line of Sifzz code (for module callbacks)"""
-        line = line.strip()
-        if not line or line.startswith('#'):
-            return
+    def parse_ask(self, line):
+        match = RE_ASK.match(line)
+        if match:
+            return Statement('ask', match.groups())
         
-        if not self.execute_line(line):
-            self.try_module_commands(line)
+        match = RE_ASK_NUMBER.match(line)
+        if match:
+            return Statement('ask_number', match.groups())
+        return None
+    
+    def parse_named(self, kind, line):
+        """`<command> <name>` - a bare command is not one"""
+        words = line.split()
+        if len(words) < 2:
+            return None
+        return Statement(kind, (words[1],))
     
-    def execute_block(self, lines, start, end):
-        """Execute a block of code"""
+    def parse_increase(self, line):
+        return self.parse_named('increase', line)
+    
+    def parse_decrease(self, line):
+        return self.parse_named('decrease', line)
+    
+    ###############
+    ### Execute ###
+    ###############
+    
+    def execute_block(self, nodes, start, end):
+        """Execute a block of compiled statements"""
         i = start
         while i < end:
             if self.loop_break:
                 break
-                
-            line = lines[i].strip()
+            
+            stmt = nodes[i]
             
             # Skip empty lines and comments
-            if not line or line.startswith('#'):
+            if stmt is None:
                 i += 1
                 continue
             
-            # Stop script command
-            if line == 'stop script':
-                sys.exit(0)
-            
-            # Break command
-            if line == 'break':
-                self.loop_break = True
-                break
-            
-            # Handle loops
-            if line.startswith('loop while '):
-                i = self.handle_loop(lines, i)
-                continue
-            
-            # Handle if statements
-            if line.startswith('if '):
-                i = self.handle_if(lines, i)
+            # Handle loops, if statements and function definitions
+            handler = self.blocks.get(stmt.kind)
+            if handler is not None:
+                i = handler(nodes, i)
                 continue
             
-            # Try to execute line
-            if not self.execute_line(line):
-                if not self.try_module_commands(line):
-                    print(f"[WARNING] Unknown command: {line}")
-            
+            self.execute_statement(stmt)
             i += 1
         
         return i
     
+    def execute_statement(self, stmt):
+        """Execute a single (non-block) statement"""
+        self.executors[stmt.kind](stmt)
+    
+    def execute_line(self, line):
+        """Execute a single line of code - returns True if handled"""
+        stmt = self.compile_line(line)
+        if stmt is None:
+            return True
+        if stmt.kind in ('module', 'unknown'):
+            return False
+        
+        self.execute_statement(stmt)
+        return True
+    
     def try_module_commands(self, line):
         """Try to execute a command using loaded modules"""
-        for module in self.modules:
-            for pattern, command_info in module.commands.items():
-                match = re.match(pattern, line)
-                if match:
-                    handler = command_info['handler']
-                    try:
-                        handler(match)
-                        return True
-                    except Exception as e:
-                        print(f"[ERROR] Module command failed: {e}")
-                        if DEBUG_MODE:
-                            import traceback
-                            traceback.print_exc()
-                        return False
-        return False
-    
-    def find_block_end(self, lines, start, end_marker):
-        """Find the end of a block"""
-        depth = 1
-        i = start + 1
-        
-        block_starters = ['if ', 'repeat ', 'loop ', 'for each ', 'function ']
-        block_enders = {
-            'if ': 'end if',
-            'repeat ': 'end repeat',
-            'loop ': 'end loop',
-            'for each ': 'end for',
-            'function ': 'end function'
-        }
-        
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            # Check for block starters
-            for starter in block_starters:
-                if line.startswith(starter):
-                    depth += 1
-                    break
-            
-            # Check for block enders
-            if line in block_enders.values():
-                depth -= 1
-                if depth == 0 and line == end_marker:
-                    return i
-            
-            # Handle else/else if
-            if (line.startswith('else if ') or line == 'else:') and depth == 1:
-                return i - 1
-            
-            i += 1
-        
-        return i
+        stmt = self.parse_module_command(line)
+        stmt.text = line
+        self.link(stmt)
+        if stmt.kind == 'unknown':
+            return False
+        return self.run_module_command(stmt)
+    
+    def run_module_command(self, stmt):
+        """Call a module handler with its pre-bound match"""
+        handler, match = stmt.code
+        # Modules print on their own, so what the script said comes first
+        self.output.drain()
+        try:
+            handler(match)
+            return True
+        except Exception as e:
+            self.report_module_error(e)
+            return False
     
-    def handle_if(self, lines, start):
+    def report_module_error(self, error):
+        print(f"[ERROR] Module command failed: {error}")
+        if DEBUG_MODE:
+            import traceback
+            traceback.print_exc()
+    
+    def handle_if(self, nodes, start):
         """Handle if/else if/else statements"""
-        line = lines[start].strip()
-        match = re.match(r'if (.+):', line)
-        
-        if not match:
+        if nodes[start].args[0] is None:
             return start + 1
         
-        condition = match.group(1)
-        block_end = self.find_block_end(lines, start, 'end if')
-        
-        if self.eval_condition(condition):
-            # Execute if block until else/else if
-            next_block = block_end
-            for i in range(start + 1, block_end):
-                if lines[i].strip().startswith('else'):
-                    next_block = i
-                    break
-            self.execute_block(lines, start + 1, next_block)
-            return block_end + 1
-        else:
-            # Look for matching else if/else
-            i = start + 1
-            while i < block_end:
-                line = lines[i].strip()
-                if line.startswith('else if '):
-                    match = re.match(r'else if (.+):', line)
-                    if match and self.eval_condition(match.group(1)):
-                        next_block = block_end
-                        for j in range(i + 1, block_end):
-                            if lines[j].strip().startswith('else'):
-                                next_block = j
-                                break
-                        self.execute_block(lines, i + 1, next_block)
-                        return block_end + 1
-                elif line == 'else:':
-                    self.execute_block(lines, i + 1, block_end)
-                    return block_end + 1
-                i += 1
+        for header, body_end in nodes[start].branches:
+            stmt = nodes[header]
+            if stmt.kind == 'else':
+                self.execute_block(nodes, header + 1, body_end)
+                break
+            condition = stmt.code[0]
+            if condition is not None and condition():
+                self.execute_block(nodes, header + 1, body_end)
+                break
         
-        return block_end + 1
+        return nodes[start].end + 1
     
-    def handle_loop(self, lines, start):
+    def handle_loop(self, nodes, start):
         """Handle while loops"""
-        line = lines[start].strip()
-        match = re.match(r'loop while (.+):', line)
+        stmt = nodes[start]
+        condition = stmt.code[0]
         
-        if not match:
+        if condition is None:
             return start + 1
         
-        condition = match.group(1)
         block_start = start + 1
-        block_end = self.find_block_end(lines, start, 'end loop')
+        block_end = stmt.end
         
-        while self.eval_condition(condition):
+        while condition():
             # Execute the block
-            self.execute_block(lines, block_start, block_end)
-            
-            # Check for break or stop script
-            if self.loop_break:
-                self.loop_break = False
-                return block_end + 1
+            self.execute_block(nodes, block_start, block_end)
             
-            # Re-evaluate variables for next iteration
-            try:
-                if 'guesses' in self.variables:
-                    if DEBUG_MODE:
-                        print(f"[DEBUG] Current guesses: {self.variables['guesses']}")
-            except Exception as e:
-                if DEBUG_MODE:
-                    print(f"[DEBUG] Error checking variables: {e}")
+            # Check for break, continue or stop script
+            if self.loop_break and self.finish_iteration():
+                break
         
         return block_end + 1
     
-    def handle_foreach(self, lines, start):
-        """Handle for each loops"""
-        line = lines[start].strip()
-        match = re.match(r'for each (\w+) in (.+):', line)
-        
-        if not match:
-            return start + 1
+    def handle_repeat(self, nodes, start):
+        """Handle repeat N times loops"""
+        stmt = nodes[start]
+        block_start = start + 1
+        block_end = stmt.end
         
-        var_name = match.group(1)
-        list_expr = match.group(2)
+        try:
+            count = int(stmt.code[0]())
+        except (TypeError, ValueError):
+            self.output.write(f"[WARNING] Cannot repeat a non-number of times: {stmt.text}\n")
+            return block_end + 1
         
-        if list_expr in self.lists:
-            items = self.lists[list_expr]
-        else:
-            range_match = re.match(r'range\((\d+),\s*(\d+)\)', list_expr)
-            if range_match:
-                items = list(range(int(range_match.group(1)), int(range_match.group(2))))
-            else:
-                items = []
+        execute_block = self.execute_block
+        for _ in range(count):
+            execute_block(nodes, block_start, block_end)
+            if self.loop_break and self.finish_iteration():
+                break
         
+        return block_end + 1
+    
+    def handle_foreach(self, nodes, start):
+        """Handle for each loops over a list or a range"""
+        stmt = nodes[start]
         block_start = start + 1
-        block_end = self.find_block_end(lines, start, 'end for')
+        block_end = stmt.end
+        
+        slot = stmt.code[0]
+        items = self.foreach_items(stmt)
         
+        values = self.values
+        execute_block = self.execute_block
         for item in items:
-            self.variables[var_name] = item
-            self.loop_break = False
-            self.loop_continue = False
-            self.execute_block(lines, block_start, block_end)
-            if self.loop_break:
-                self.loop_break = False
+            values[slot] = item
+            execute_block(nodes, block_start, block_end)
+            if self.loop_break and self.finish_iteration():
                 break
         
         return block_end + 1
     
-    def execute_line(self, line):
-        """Execute a single line of code - returns True if handled"""
-        if DEBUG_MODE:
-            print(f"[DEBUG] Executing line: {line}")
-            
-        # First check for stop script
-        if line == 'stop script':
-            sys.exit(0)
-            return True
-            
-        # Handle break command
-        if line == 'break':
-            self.loop_break = True
-            return True
-
-        if line in ['end if', 'end loop', 'end repeat', 'end for', 'end function'] or \
-        line == 'else:' or line.startswith('else if '):
-            return True
-        
-        # Set variable
-        if line.startswith('set ') and ' to ' in line:
-            match = re.match(r'set (\w+) to (.+)', line)
-            if match:
-                var_name = match.group(1)
-                value = self.eval_expression(match.group(2))
-                self.variables[var_name] = value
-                return True
-        
-        # Create list
-        if line.startswith('create list '):
-            list_name = line.split()[2]
-            self.lists[list_name] = []
-            return True
-        
-        # Add to list/variable
-        if line.startswith('add ') and ' to ' in line:
-            match = re.match(r'add (.+) to (\w+)', line)
-            if match:
-                value = self.eval_expression(match.group(1))
-                target = match.group(2)
-                
-                if target in self.lists:
-                    self.lists[target].append(value)
-                elif target in self.variables:
-                    self.variables[target] += value
-                else:
-                    self.variables[target] = value
-                return True
-        
-        # Remove from list
-        if line.startswith('remove ') and ' from ' in line:
-            match = re.match(r'remove (.+) from (\w+)', line)
-            if match:
-                value = self.eval_expression(match.group(1))
-                list_name = match.group(2)
-                if list_name in self.lists:
-                    try:
-                        self.lists[list_name].remove(value)
-                    except ValueError:
-                        pass
-                return True
-        
-        # Get list size
-        if 'size of' in line:
-            match = re.match(r'set (\w+) to size of (\w+)', line)
-            if match:
-                var_name = match.group(1)
-                list_name = match.group(2)
-                if list_name in self.lists:
-                    self.variables[var_name] = len(self.lists[list_name])
-                return True
-        
-        # Get list item
-        if 'item' in line and ' of ' in line:
-            match = re.match(r'set (\w+) to item (\d+) of (\w+)', line)
-            if match:
-                var_name = match.group(1)
-                index = int(match.group(2))
-                list_name = match.group(3)
-                if list_name in self.lists and index < len(self.lists[list_name]):
-                    self.variables[var_name] = self.lists[list_name][index]
-                return True
-        
-        # Clear list
-        if line.startswith('clear '):
-            list_name = line.split()[1]
-            if list_name in self.lists:
-                self.lists[list_name].clear()
-            return True
-        
-        # Say/Print
-        if line.startswith('say '):
-            message = line[4:].strip()
-            output = self.eval_expression(message)
-            print(output)
-            return True
-        
-        # Write without newline
-        if line.startswith('write '):
-            message = line[6:].strip()
-            output = self.eval_expression(message)
-            print(output, end='')
-            return True
-        
-        # Newline
-        if line == 'newline':
-            print()
-            return True
-        
-        # Wait
-        if line.startswith('wait '):
-            match = re.match(r'wait (\d+\.?\d*) seconds?', line)
-            if match:
-                time.sleep(float(match.group(1)))
-                return True
-        
-        # Subtract
-        if line.startswith('subtract ') and ' from ' in line:
-            match = re.match(r'subtract (.+) from (\w+)', line)
-            if match:
-                value = self.eval_expression(match.group(1))
-                var_name = match.group(2)
-                if var_name in self.variables:
-                    self.variables[var_name] -= value
-                return True
-        
-        # Multiply
-        if line.startswith('multiply ') and ' by ' in line:
-            match = re.match(r'multiply (\w+) by (.+)', line)
-            if match:
-                var_name = match.group(1)
-                value = self.eval_expression(match.group(2))
-                if var_name in self.variables:
-                    self.variables[var_name] *= value
-                return True
-        
-        # Divide
-        if line.startswith('divide ') and ' by ' in line:
-            match = re.match(r'divide (\w+) by (.+)', line)
-            if match:
-                var_name = match.group(1)
-                value = self.eval_expression(match.group(2))
-                if var_name in self.variables and value != 0:
-                    self.variables[var_name] /= value
-                return True
-        
-        # Call function
-        if line.startswith('call '):
-            func_name = line[5:].strip()
-            if func_name in self.functions:
-                func_start, func_end = self.functions[func_name]
-                self.execute_block(self.all_lines, func_start, func_end)
-                return True
-        
-        # Ask for input
-        if line.startswith('ask '):
-            match = re.match(r'ask "([^"]+)" and store in (\w+)', line)
-            if match:
-                prompt = match.group(1)
-                var_name = match.group(2)
-                self.variables[var_name] = input(prompt + " ")
-                return True
-        
-        # Ask for number
-        if line.startswith('ask for number '):
-            match = re.match(r'ask for number "([^"]+)" and store in (\w+)', line)
-            if match:
-                prompt = match.group(1)
-                var_name = match.group(2)
-                try:
-                    self.variables[var_name] = float(input(prompt + " "))
-                except ValueError:
-                    self.variables[var_name] = 0
-                return True
-        
-        # Random number
-        if 'random number between' in line:
-            match = re.match(r'set (\w+) to random number between (.+) and (.+)', line)
-            if match:
-                var_name = match.group(1)
-                min_val = int(self.eval_expression(match.group(2)))
-                max_val = int(self.eval_expression(match.group(3)))
-                self.variables[var_name] = random.randint(min_val, max_val)
-                return True
+    def foreach_items(self, stmt):
+        """What a for each loop iterates over: a range, or the items of a
+        collection (see loop_items)"""
+        if len(stmt.code) == 3:
+            low, high = stmt.code[1:]
+            try:
+                return range(int(low()), int(high()))
+            except (TypeError, ValueError):
+                return ()
+        return loop_items(self.lists.get(stmt.code[1], ()))
+    
+    def finish_iteration(self):
+        """Clear break/continue after a loop body stopped early.
         
-        # Random choice
-        if 'random choice from' in line:
-            match = re.match(r'set (\w+) to random choice from (\w+)', line)
-            if match:
-                var_name = match.group(1)
-                list_name = match.group(2)
-                if list_name in self.lists and self.lists[list_name]:
-                    self.variables[var_name] = random.choice(self.lists[list_name])
-                return True
-        
-        # Increase
-        if line.startswith('increase '):
-            var_name = line.split()[1]
-            if var_name in self.variables:
-                self.variables[var_name] += 1
+        Returns True if the loop should end (break), False if it should go
+        on with the next iteration (continue).
+        """
+        self.loop_break = False
+        if self.loop_continue:
+            self.loop_continue = False
+            return False
+        return True
+    
+    def skip_block(self, nodes, start):
+        """Step over a block that only runs when called (function bodies)"""
+        return nodes[start].end + 1
+    
+    #################
+    ### Executors ###
+    #################
+    
+    def exec_stop(self, stmt):
+        sys.exit(0)
+    
+    def exec_break(self, stmt):
+        self.loop_break = True
+    
+    def exec_continue(self, stmt):
+        # Stops the rest of the loop body the same way break does; the loop
+        # then sees loop_continue and keeps going
+        self.loop_break = True
+        self.loop_continue = True
+    
+    def exec_noop(self, stmt):
+        pass
+    
+    def exec_unknown(self, stmt):
+        self.output.write(f"[WARNING] Unknown command: {stmt.text}\n")
+    
+    def exec_module(self, stmt):
+        self.run_module_command(stmt)
+    
+    def exec_set(self, stmt):
+        slot, expr = stmt.code
+        self.values[slot] = expr()
+    
+    def exec_size(self, stmt):
+        slot, list_name = stmt.code
+        if list_name in self.lists:
+            self.values[slot] = len(self.lists[list_name])
+    
+    def exec_item(self, stmt):
+        slot, index, list_name = stmt.code
+        collection = self.lists.get(list_name)
+        if collection is None:
+            return
+        try:
+            if type(collection) is dict:
+                # Maps are read by key
+                key = index()
+                if key in collection:
+                    self.values[slot] = collection[key]
             else:
-                self.variables[var_name] = 1
-            return True
-        
-        # Decrease
-        if line.startswith('decrease '):
-            var_name = line.split()[1]
-            if var_name in self.variables:
-                self.variables[var_name] -= 1
+                self.values[slot] = collection[int(index())]
+        except (IndexError, TypeError, ValueError):
+            pass
+    
+    def exec_random_number(self, stmt):
+        slot, low, high = stmt.code
+        self.values[slot] = self.random.randint(int(low()), int(high()))
+    
+    def exec_random_choice(self, stmt):
+        slot, list_name = stmt.code
+        if list_name in self.lists and self.lists[list_name]:
+            self.values[slot] = self.random.choice(loop_items(self.lists[list_name]))
+    
+    def numpy_random(self):
+        """A NumPy Generator for the random commands on number arrays, or
+        None without NumPy. It is seeded from self.random, so `set random
+        seed` decides its numbers too."""
+        numpy = load_numpy()
+        if numpy is None:
+            return None
+        if self.bulk_random is None:
+            self.bulk_random = numpy.random.default_rng(self.random.getrandbits(64))
+        return self.bulk_random
+    
+    def exec_seed(self, stmt):
+        seed = stmt.code[0]()
+        if isinstance(seed, float) and seed.is_integer():
+            seed = int(seed)
+        try:
+            self.random.seed(seed)
+        except TypeError:
+            self.output.write(f"[WARNING] A random seed must be a number or text: {stmt.text}\n")
+            return
+        self.bulk_random = None
+    
+    def exec_sample(self, stmt):
+        target, count, list_name = stmt.code
+        collection = self.lists.get(list_name)
+        if collection is None:
+            return
+        try:
+            count = int(count())
+            if type(collection) is not array:
+                picked = self.random.sample(loop_items(collection), count)
+            elif collection and self.numpy_random() is not None:
+                numbers = load_numpy().frombuffer(collection)
+                picked = array('d')
+                picked.frombytes(self.bulk_random.choice(numbers, count, replace=False).tobytes())
             else:
-                self.variables[var_name] = -1
-            return True
+                picked = array('d', self.random.sample(collection, count))
+        except (TypeError, ValueError):
+            self.output.write(f"[WARNING] Cannot pick that many items from {list_name}: {stmt.text}\n")
+            return
+        self.lists[target] = picked
+    
+    def exec_fill_random(self, stmt):
+        list_name, count, low, high = stmt.code
+        try:
+            count, low, high = int(count()), int(low()), int(high())
+        except (TypeError, ValueError):
+            self.output.write(f"[WARNING] fill needs a number of items and two whole numbers: {stmt.text}\n")
+            return
+        if count < 0 or low > high:
+            self.output.write(f"[WARNING] Cannot pick {count} numbers between {low} and {high}: {stmt.text}\n")
+            return
         
-        # Exit
-        if line == 'exit':
-            sys.exit(0)
-            return True
+        # A number array stays one (filled by NumPy when it is installed),
+        # anything else becomes a list
+        existing = self.lists.get(list_name)
+        generator = self.numpy_random() if type(existing) is array else None
+        if generator is not None:
+            filled = array('d')
+            filled.frombytes(generator.integers(low, high, size=count, endpoint=True).astype('d').tobytes())
+        else:
+            filled = self.random.choices(range(low, high + 1), k=count)
+            if type(existing) is array:
+                filled = array('d', filled)
         
-        return False
+        # Lists are refilled in place, so loops over them see the new items
+        if type(existing) is array or type(existing) is list:
+            existing[:] = filled
+        else:
+            self.lists[list_name] = filled
     
-    def eval_expression(self, expr):
-        """Evaluate an expression"""
-        expr = expr.strip()
-        
-        # Random number between expression
-        match = re.match(r'random number between (\d+) and (\d+)', expr)
-        if match:
-            min_val = int(match.group(1))
-            max_val = int(match.group(2))
-            output_rannumexp = random.randint(min_val, max_val)
-            if DEBUG_MODE:
-                print('[DEBUG] Random Number Is: ' + str(output_rannumexp))
-            return output_rannumexp
-        
-        # String literal
-        if expr.startswith('"') and expr.endswith('"'):
-            return expr[1:-1]
-        
-        # Math functions
-        if expr.startswith('sqrt('):
-            inner = expr[5:-1]
-            return math.sqrt(self.eval_expression(inner))
-        
-        if expr.startswith('round('):
-            inner = expr[6:-1]
-            return round(self.eval_expression(inner))
-        
-        if expr.startswith('abs('):
-            inner = expr[4:-1]
-            return abs(self.eval_expression(inner))
-        
-        # String functions
-        if ' uppercase' in expr:
-            var = expr.split()[0]
-            if var in self.variables:
-                return str(self.variables[var]).upper()
-        
-        if ' lowercase' in expr:
-            var = expr.split()[0]
-            if var in self.variables:
-                return str(self.variables[var]).lower()
-        
-        if 'length of' in expr:
-            var = expr.split()[-1]
-            if var in self.variables:
-                return len(str(self.variables[var]))
-            if var in self.lists:
-                return len(self.lists[var])
-        
-        # Number
-        try:
-            if '.' in expr:
-                return float(expr)
-            return int(expr)
-        except ValueError:
+    def exec_shuffle(self, stmt):
+        collection = self.lists.get(stmt.code[0])
+        if type(collection) is list:
+            self.random.shuffle(collection)
+        elif type(collection) is array:
+            if collection and self.numpy_random() is not None:
+                self.bulk_random.shuffle(load_numpy().frombuffer(collection))
+            else:
+                self.random.shuffle(collection)
+    
+    def exec_create_list(self, stmt):
+        self.lists[stmt.code[0]] = []
+    
+    def exec_create_set(self, stmt):
+        self.lists[stmt.code[0]] = set()
+    
+    def exec_create_map(self, stmt):
+        self.lists[stmt.code[0]] = {}
+    
+    def exec_create_array(self, stmt):
+        name, source = stmt.code
+        numbers = array('d')
+        if source is not None:
+            try:
+                numbers.extend(map(float, loop_items(self.lists.get(source, ()))))
+            except (TypeError, ValueError):
+                self.output.write(f"[WARNING] {source} has items that are not numbers: {stmt.text}\n")
+                return
+        self.lists[name] = numbers
+    
+    def number_array(self, stmt, name):
+        """The number array called name, or None with a warning"""
+        numbers = self.lists.get(name)
+        if type(numbers) is not array:
+            self.output.write(f"[WARNING] {name} is not a number array: {stmt.text}\n")
+            return None
+        return numbers
+    
+    def array_operand_value(self, stmt, array_name, expr):
+        if array_name is None:
+            return expr()
+        return self.number_array(stmt, array_name)
+    
+    def exec_array_op(self, stmt):
+        op, name, other_name, expr = stmt.code
+        numbers = self.number_array(stmt, name)
+        if numbers is None:
+            return
+        operand = self.array_operand_value(stmt, other_name, expr)
+        if operand is None:
+            return
+        try:
+            array_arithmetic(op, numbers, operand)
+        except (TypeError, ValueError) as e:
+            self.output.write(f"[WARNING] Array command failed ({e}): {stmt.text}\n")
+    
+    def exec_array_compare(self, stmt):
+        target, op, name, other_name, expr = stmt.code
+        numbers = self.number_array(stmt, name)
+        if numbers is None:
+            return
+        operand = self.array_operand_value(stmt, other_name, expr)
+        if operand is None:
+            return
+        try:
+            self.lists[target] = array_compare(op, numbers, operand)
+        except (TypeError, ValueError) as e:
+            self.output.write(f"[WARNING] Array command failed ({e}): {stmt.text}\n")
+    
+    def exec_set_key(self, stmt):
+        key, map_name, value = stmt.code
+        collection = self.lists.get(map_name)
+        if type(collection) is not dict:
+            self.output.write(f"[WARNING] {map_name} is not a map: {stmt.text}\n")
+            return
+        try:
+            collection[key()] = value()
+        except TypeError:
+            self.output.write(f"[WARNING] Cannot use a list as a map key: {stmt.text}\n")
+    
+    def exec_add(self, stmt):
+        expr, slot = stmt.code
+        value = expr()
+        target = stmt.args[1]
+        
+        collection = self.lists.get(target)
+        if collection is not None:
+            if type(collection) is list:
+                collection.append(value)
+            else:
+                self.add_to_collection(stmt, collection, value)
+        elif self.values[slot] is UNSET:
+            self.values[slot] = value
+        else:
+            self.values[slot] = append_value(self.values[slot], value)
+    
+    def add_to_collection(self, stmt, collection, value):
+        """`add` for the collections that are not lists"""
+        if type(collection) is dict:
+            self.output.write(f"[WARNING] Use 'set key ... of {stmt.args[1]} to ...' to add to a map: {stmt.text}\n")
+            return
+        if type(collection) is array:
+            try:
+                collection.append(value)
+            except TypeError:
+                self.output.write(f"[WARNING] Only numbers can be added to a number array: {stmt.text}\n")
+            return
+        try:
+            collection.add(value)
+        except TypeError:
+            self.output.write(f"[WARNING] Cannot add a list to a set: {stmt.text}\n")
+    
+    def exec_remove(self, stmt):
+        expr, list_name = stmt.code
+        value = expr()
+        collection = self.lists.get(list_name)
+        if collection is None:
+            return
+        try:
+            if type(collection) is list or type(collection) is array:
+                collection.remove(value)
+            elif type(collection) is set:
+                collection.discard(value)
+            else:
+                # Removing from a map removes a key
+                collection.pop(value, None)
+        except (ValueError, TypeError):
             pass
-        
-        # Variable
-        if expr in self.variables:
-            return self.variables[expr]
-        
-        # Expression with variables
-        original_expr = expr
-        for var_name, var_value in self.variables.items():
-            expr = expr.replace(var_name, str(var_value))
-        
-        # String concatenation
-        if '+' in original_expr:
-            parts = original_expr.split('+')
-            result = ''
-            for part in parts:
-                part = part.strip()
-                val = self.eval_expression(part)
-                result += str(val)
-            return result
-        
+    
+    def exec_clear(self, stmt):
+        list_name = stmt.code[0]
+        collection = self.lists.get(list_name)
+        if type(collection) is array:
+            # Number arrays have no clear()
+            del collection[:]
+        elif collection is not None:
+            collection.clear()
+    
+    def exec_aggregate(self, stmt):
+        slot, name, list_name = stmt.code
+        collection = self.lists.get(list_name)
+        if collection is None:
+            return
+        try:
+            if type(collection) is array:
+                self.values[slot] = array_aggregate(name, collection)
+            else:
+                self.values[slot] = AGGREGATES[name](collection)
+        except (TypeError, ValueError):
+            # Empty, or a mix of numbers and text
+            pass
+    
+    def exec_slice(self, stmt):
+        target, start, end, list_name = stmt.code
+        collection = self.lists.get(list_name)
+        if type(collection) is not list and type(collection) is not array:
+            return
+        try:
+            self.lists[target] = collection[int(start()):int(end())]
+        except (TypeError, ValueError):
+            pass
+    
+    def exec_sort(self, stmt):
+        collection = self.lists.get(stmt.code[0])
+        if type(collection) is array:
+            sort_array(collection)
+            return
+        if type(collection) is not list:
+            return
+        try:
+            collection.sort()
+        except TypeError:
+            self.output.write(f"[WARNING] Cannot sort a list of both numbers and text: {stmt.text}\n")
+    
+    def exec_reverse(self, stmt):
+        collection = self.lists.get(stmt.code[0])
+        if type(collection) is list or type(collection) is array:
+            collection.reverse()
+    
+    def exec_dedupe(self, stmt):
+        collection = self.lists.get(stmt.code[0])
+        if type(collection) is array:
+            collection[:] = array('d', dict.fromkeys(collection))
+            return
+        if type(collection) is not list:
+            return
+        # Keeps the first of each item, in order. The list is changed in
+        # place, so loops over it see the change
+        try:
+            collection[:] = dict.fromkeys(collection)
+        except TypeError:
+            # Lists inside the list can't be hashed
+            unique = []
+            for item in collection:
+                if item not in unique:
+                    unique.append(item)
+            collection[:] = unique
+    
+    def exec_say(self, stmt):
+        self.output.write(to_text(stmt.code[0]()) + '\n')
+    
+    def exec_say_text(self, stmt):
+        self.output.write(stmt.code[0] + '\n')
+    
+    def exec_write(self, stmt):
+        self.output.write(to_text(stmt.code[0]()))
+    
+    def exec_newline(self, stmt):
+        self.output.write('\n')
+    
+    def exec_flush(self, stmt):
+        self.output.flush()
+    
+    def exec_wait(self, stmt):
+        time.sleep(stmt.code[0])
+    
+    def exec_subtract(self, stmt):
+        expr, slot = stmt.code
+        value = expr()
+        if self.values[slot] is not UNSET:
+            self.values[slot] -= value
+    
+    def exec_multiply(self, stmt):
+        slot, expr = stmt.code
+        value = expr()
+        if self.values[slot] is not UNSET:
+            # Text can be repeated, so join any text being built first
+            self.values[slot] = join_text(self.values, slot) * value
+    
+    def exec_divide(self, stmt):
+        slot, expr = stmt.code
+        value = expr()
+        if self.values[slot] is not UNSET and value != 0:
+            self.values[slot] /= value
+    
+    def exec_call(self, stmt):
+        function = stmt.code[0]
+        if function is None:
+            self.output.write(f"[WARNING] Unknown function: {stmt.args[0]}\n")
+            return
+        function.call(self, [arg() for arg in stmt.code[1:]])
+    
+    def exec_ask(self, stmt):
+        prompt, slot = stmt.code
+        self.output.flush()
+        self.values[slot] = input(prompt + " ")
+    
+    def exec_ask_number(self, stmt):
+        prompt, slot = stmt.code
+        self.output.flush()
         try:
-            return eval(expr)
-        except:
-            return expr
+            self.values[slot] = float(input(prompt + " "))
+        except ValueError:
+            self.values[slot] = 0
+    
+    def exec_increase(self, stmt):
+        slot = stmt.code[0]
+        value = self.values[slot]
+        self.values[slot] = 1 if value is UNSET else value + 1
+    
+    def exec_decrease(self, stmt):
+        slot = stmt.code[0]
+        value = self.values[slot]
+        self.values[slot] = -1 if value is UNSET else value - 1
+    
+    ########################
+    ### Expression Logic ###
+    ########################
+    
+    def eval_expression(self, expr):
+        """Evaluate an expression"""
+        return self.expression_cache.get(expr.strip())()
     
     def eval_condition(self, condition):
         """Evaluate a condition"""
-        original = condition
-        
-        condition = condition.replace(' is not ', ' != ')
-        condition = condition.replace(' is ', ' == ')
-        condition = condition.replace(' equals ', ' == ')
-        condition = condition.replace(' greater than or equal to ', ' >= ')
-        condition = condition.replace(' less than or equal to ', ' <= ')
-        condition = condition.replace(' greater than ', ' > ')
-        condition = condition.replace(' less than ', ' < ')
-        
-        # Handle 'contains'
-        if ' contains ' in original:
-            parts = original.split(' contains ')
-            container = self.eval_expression(parts[0].strip())
-            item = self.eval_expression(parts[1].strip())
-            return item in container
-        
-        # Replace variables
-        for var_name, var_value in self.variables.items():
-            if isinstance(var_value, str):
-                condition = condition.replace(var_name, f'"{var_value}"')
-            else:
-                condition = condition.replace(var_name, str(var_value))
-        
-        if DEBUG_MODE:
-            print(condition)
-
-        try:
-            return eval(condition)
-        except:
-            return False
+        return self.condition_cache.get(condition.strip())()
 
 def main():
     """Main entry point"""
@@ -759,13 +3726,18 @@ def main():
     import urllib.error
 
     parser = argparse.ArgumentParser(
-        description='Sifzz Interpreter v3.2 - A beginner-friendly scripting language',
+        description=f'Sifzz Interpreter v{SIFZZ_VERSION} - A beginner-friendly scripting language',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
   python sifzz.py program.sfzz
   python sifzz.py program.sfzz --debug
   python sifzz.py program.sfzz -d
+  python sifzz.py program.sfzz --no-cache
+  python sifzz.py program.sfzz --transpile
+  python sifzz.py program.sfzz --profile
+  python sifzz.py program.sfzz --sample stacks.txt
+  python sifzz.py program.sfzz --output-buffer 0
   python sifzz.py -i module_name
   python sifzz.py --init
         """
@@ -775,6 +3747,13 @@ Examples:
     parser.add_argument('-d', '--debug', action='store_true', help='Enable debug mode')
     parser.add_argument('-i', '--install-module', help='Install module from SifzzLang/sifzz repository')
     parser.add_argument('-c', '--create', '--init', dest='init', action='store_true', help='Initialize a new Sifzz project')
+    parser.add_argument('--no-cache', action='store_true', help='Always compile the script instead of using __sfzzcache__')
+    parser.add_argument('--transpile', action='store_true', help='Run the script as generated Python code (faster for long-running scripts)')
+    parser.add_argument('--profile', action='store_true', help='Show how much time each line of the script takes')
+    parser.add_argument('--profile-json', metavar='FILE', help='Also write the profile to FILE as JSON (implies --profile)')
+    parser.add_argument('--sample', metavar='FILE', help='Sample the running script and write collapsed stacks (for flamegraphs) to FILE')
+    parser.add_argument('--sample-interval', type=float, default=5.0, metavar='MS', help='Time between samples for --sample in milliseconds (default: 5)')
+    parser.add_argument('--output-buffer', type=int, metavar='CHARS', help='Hold back up to CHARS characters of output before writing them (0 writes every line straight away; default: 0 on a terminal, 65536 otherwise; ignored with --debug)')
 
     args = parser.parse_args()
 
@@ -837,14 +3816,35 @@ Examples:
             print(f"Error installing module: {e}")
             sys.exit(1)
 
-if __name__ == "__main__":
-    main()
-
     # If a filename is provided, run the interpreter
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('filename', nargs='?', help='Sifzz script file (.sfzz)')
-    args, unknown = parser.parse_known_args()
     if args.filename:
         interpreter = SifzzInterpreter()
-        interpreter.run_file(args.filename)
\ No newline at end of file
+        # Debug output is never buffered, see SifzzInterpreter.__init__
+        if args.output_buffer is not None and not DEBUG_MODE:
+            interpreter.output = OutputBuffer(max(args.output_buffer, 0))
+        profiler = None
+        if args.profile or args.profile_json:
+            if args.transpile:
+                print("[WARNING] --profile runs the script without --transpile")
+                args.transpile = False
+            profiler = Profiler(interpreter)
+            profiler.start()
+        sampler = None
+        if args.sample:
+            sampler = SamplingProfiler(interpreter, args.sample_interval / 1000)
+            sampler.start()
+        try:
+            interpreter.run_file(args.filename, use_cache=not args.no_cache, transpile=args.transpile)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                sampler.write(args.sample)
+                print(f"[SAMPLE] Wrote {sampler.samples} samples to {args.sample}", file=sys.stderr)
+            if profiler is not None:
+                profiler.stop()
+                profiler.report()
+                if args.profile_json:
+                    profiler.write_json(args.profile_json)
+
+if __name__ == "__main__":
+    main()